@@ -1,24 +1,67 @@
 #!/usr/bin/python2.7
 
 from bson.objectid import ObjectId
-from copy import copy
+from copy import copy, deepcopy
 from datetime import datetime, timedelta
+import hashlib
 import json
-from bson import json_util
+from bson import BSON, json_util
 import inspect
 import operator
 import random
 
 from flask import request, Response
+from pymongo import ReplaceOne
 
+import counters
+import settings
+import user_directory
 import utils
 import models
 
+
+# per-process tally of how often UserAsset.normalize_if_stale() gets to skip
+#   normalization; flushed to mdb.normalization_stats every so often (see
+#   UserAsset.record_normalization())
+normalization_stats = {"since": datetime.now(), "counts": {}}
+
+
 #
 #   Base classes for game assets are here. Also, special exceptions for those
 #       classes live here as well.
 #
 
+# dispatch table for UserAsset attribs whose assets don't live in the models
+#   module with the same name, e.g. settlement principles are innovations
+asset_modules = {
+    "principles": "innovations",
+}
+
+
+def get_asset_module(attrib):
+    """ Returns the models module for a UserAsset attrib, e.g. 'locations' or
+    'abilities_and_impairments'. Raises AttributeError if there isn't one. """
+
+    return getattr(models, asset_modules.get(attrib, attrib))
+
+
+def get_asset_collection(attrib):
+    """ Returns an initialized AssetCollection (i.e. an Assets() object) for a
+    UserAsset attrib. """
+
+    return get_asset_module(attrib).Assets()
+
+
+def get_asset_records(attrib):
+    """ Returns the process-wide {handle: AssetRecord} dict for a UserAsset
+    attrib. Only initializes an Assets() object the first time. """
+
+    records = asset_records.get(get_asset_module(attrib).Assets, None)
+    if records is None:
+        records = get_asset_collection(attrib).get_records()
+    return records
+
+
 class AssetMigrationError(Exception):
     """ Handler for asset migration/conversion errors. """
 
@@ -44,6 +87,121 @@ class AssetLoadError(Exception):
         Exception.__init__(self, message)
 
 
+
+#
+#   Asset records: immutable, shared versions of game asset dicts
+#
+
+# process-wide registry of asset records: AssetCollection class -> {handle:
+#   AssetRecord}. Built the first time anybody asks a collection for a record
+#   (see AssetCollection.get_records()) and never touched again.
+asset_records = {}
+
+
+def freeze(v):
+    """ Turns dicts into AssetRecords and lists into tuples, all the way down.
+    Everything else is left alone. """
+
+    if type(v) == dict:
+        return AssetRecord(v)
+    elif type(v) in (list, tuple):
+        return tuple([freeze(i) for i in v])
+    return v
+
+
+def thaw(v):
+    """ The opposite of freeze(): returns plain, mutable dicts and lists. """
+
+    if isinstance(v, AssetRecord):
+        return v.to_dict()
+    elif type(v) == tuple:
+        return [thaw(i) for i in v]
+    return v
+
+
+class AssetRecord(object):
+    """ A read-only, dict-like version of a game asset dict. Records are shared
+    by every AssetCollection (and every request) in the process, so there is
+    no copying going on when you get one: if you need to modify it, call
+    to_dict() and modify that.
+
+    Nested dicts are records too and nested lists are tuples, so don't expect
+    list methods on them. Use json() for a JSON string (it gets cached). """
+
+    __slots__ = ("_data", "_json")
+
+    def __init__(self, asset_dict):
+        object.__setattr__(self, "_data", dict([(k, freeze(v)) for k, v in asset_dict.iteritems()]))
+        object.__setattr__(self, "_json", None)
+
+    def __repr__(self):
+        return "AssetRecord(%s)" % self._data.get("handle", self._data.get("name", "UNKNOWN"))
+
+    def __setattr__(self, attr, value):
+        raise TypeError("AssetRecord objects are read-only!")
+
+    def __setitem__(self, key, value):
+        raise TypeError("AssetRecord objects are read-only!")
+
+    def __delitem__(self, key):
+        raise TypeError("AssetRecord objects are read-only!")
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, AssetRecord):
+            return self._data == other._data
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def iteritems(self):
+        return self._data.iteritems()
+
+    def to_dict(self):
+        """ Returns a brand new, plain (i.e. mutable) dict version of the
+        record. """
+
+        return dict([(k, thaw(v)) for k, v in self._data.iteritems()])
+
+    def json(self):
+        """ Returns the record as a JSON string. Only does the work once. """
+
+        if self._json is None:
+            object.__setattr__(self, "_json", json.dumps(self.to_dict(), default=json_util.default))
+        return self._json
+
+
+
 class AssetCollection():
     """ The base class for game asset objects, i.e. working with the dict assets
     in the assets/ folder.
@@ -274,6 +432,39 @@ class AssetCollection():
             return None
 
 
+    def get_records(self):
+        """ Returns the process-wide {handle: AssetRecord} dict for this kind of
+        collection, building it (from a fresh, unfiltered collection) if this
+        is the first time anybody has asked. Don't modify it! """
+
+        records = asset_records.get(self.__class__, None)
+        if records is None:
+            fresh = self.__class__()
+            records = dict([(h, AssetRecord(a)) for h, a in fresh.assets.iteritems()])
+            asset_records[self.__class__] = records
+        return records
+
+
+    def get_record(self, handle=None, backoff_to_name=False, raise_exception_if_not_found=True):
+        """ The zero-copy version of get_asset(): returns a shared, read-only
+        AssetRecord instead of a copy of the asset dict. Takes the same kwargs
+        as get_asset() and fails the same way. """
+
+        record = self.get_records().get(handle, None)
+
+        if record is None and backoff_to_name:
+            asset = self.get_asset_from_name(handle)
+            if asset is not None:
+                record = self.get_records().get(asset["handle"], None)
+
+        if record is None and raise_exception_if_not_found:
+            msg = "The handle '%s' could not be retrieved from %s!" % (handle, self)
+            self.logger.error(msg)
+            raise utils.InvalidUsage(msg)
+
+        return record
+
+
 
     def filter(self, filter_attrib=None, filtered_attrib_values=[], reverse=False):
         """ Drops assets from the collection if their 'filter_attrib' value is
@@ -358,19 +549,25 @@ class GameAsset(object):
 
 
     def initialize_asset(self, asset_dict):
-        """ Pass this a valid asset dictionary to set the object's attributes
-        with a bunch of exec calls. """
+        """ Pass this a valid asset dictionary to set the object's attributes.
+
+        This used to be a bunch of exec calls (one per key), which, among other
+        things, meant that every list/dict attrib came out as a brand new
+        object. We keep that part: lists and dicts get deep-copied, so objects
+        can't mess with the asset definitions in the AssetCollection. """
 
         if type(asset_dict) != dict:
             raise AssetInitError("Asset objects may not be initialized with a '%s' type object!" % type(asset_dict))
 
+        attribs = {}
         for k, v in asset_dict.iteritems():
-            if type(v) == str:
-                exec """self.%s = '%s' """ % (k,v.replace('"','\\"').replace("'","\\'"))
-            elif type(v) == datetime:
-                exec """self.%s = '%s' """ % (k,v.strftime(utils.ymd))
-            else:
-                exec "self.%s = %s" % (k,v)
+            v_type = type(v)
+            if v_type in (list, dict):
+                v = deepcopy(v)
+            elif v_type == datetime:
+                v = v.strftime(utils.ymd)
+            attribs[k] = v
+        self.__dict__.update(attribs)
 
 #            if k == 'expansion':
 #                exp_obj = models.expansions.Expansion(v)
@@ -448,6 +645,115 @@ class GameAsset(object):
 
 
 
+class WriteBuffer():
+    """ A write buffer for building a bunch of user assets (e.g. a new
+    settlement, its starting survivors and all of their settlement_events) in
+    memory and then writing all of it to mdb at once.
+
+    While a buffer is active, UserAsset objects that have it as their
+    'write_buffer' attrib insert(), save() and log_event() into the buffer
+    instead of into the mdb, and get_mdb_doc() reads from the buffer first, so
+    objects can still load() documents that haven't been written yet.
+
+    Nothing hits the mdb until flush() is called, which does one insert per
+    collection, one bulk_write() per collection for any documents that were
+    saved but not inserted, one increment per world counter and then calls
+    whatever was queued up with after_flush(). If something blows up before
+    then, nothing gets written, which is pretty much the point. """
+
+    def __init__(self):
+        self.logger = utils.get_logger()
+        self.active = True
+        self.docs = {}          # (collection, _id) -> most recent version of the doc
+        self.order = []         # (collection, _id) tuples, in order of first write
+        self.inserted = set()   # (collection, _id) tuples that get inserted
+        self.counters = {}      # counter -> amount
+        self.callbacks = []     # (function, args) tuples to call after flush()
+
+
+    def insert(self, collection, doc):
+        """ Buffers an insert. Assigns the doc an _id (like the mdb would) and
+        returns it. """
+
+        if doc.get("_id", None) is None:
+            doc["_id"] = ObjectId()
+        key = (collection, doc["_id"])
+        self.docs[key] = doc
+        self.order.append(key)
+        self.inserted.add(key)
+        return doc["_id"]
+
+
+    def save(self, collection, doc):
+        """ Buffers a save. Saving a doc that was inserted into the buffer just
+        updates what gets inserted. """
+
+        key = (collection, doc["_id"])
+        if key not in self.docs:
+            self.order.append(key)
+        self.docs[key] = doc
+
+
+    def get(self, collection, _id):
+        """ Returns the buffered version of a doc, or None if we haven't got
+        one. """
+
+        return self.docs.get((collection, _id), None)
+
+
+    def increment(self, counter, amount=1):
+        """ Buffers a world counter increment (see counters.py). """
+
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+
+    def after_flush(self, function, *args):
+        """ Queues up a call to 'function' for after flush(), i.e. for things
+        that need to read the buffered docs back out of the mdb. """
+
+        self.callbacks.append((function, args))
+
+
+    def flush(self):
+        """ Writes everything in the buffer to the mdb and deactivates the
+        buffer. Returns a dict of doc counts by collection. """
+
+        self.active = False
+
+        collections = []
+        inserts = {}
+        replaces = {}
+        for key in self.order:
+            collection, _id = key
+            if collection not in collections:
+                collections.append(collection)
+                inserts[collection] = []
+                replaces[collection] = []
+            if key in self.inserted:
+                inserts[collection].append(self.docs[key])
+            else:
+                replaces[collection].append(ReplaceOne({"_id": _id}, self.docs[key], upsert=True))
+
+        output = {}
+        for collection in collections:
+            if inserts[collection] != []:
+                utils.mdb[collection].insert(inserts[collection])
+            if replaces[collection] != []:
+                utils.mdb[collection].bulk_write(replaces[collection], ordered=False)
+            output[collection] = len(inserts[collection]) + len(replaces[collection])
+
+        for counter, amount in self.counters.iteritems():
+            counters.increment(counter, amount)
+
+        for function, args in self.callbacks:
+            function(*args)
+
+        self.logger.debug("Flushed write buffer: %s" % output)
+        return output
+
+
+
+
 class UserAsset():
     """ The base class for all user asset objects, such as survivors, sessions,
     settlements and users. All user asset controllers in the 'models' module
@@ -460,14 +766,14 @@ class UserAsset():
         reason than to make the logs look cleaner. """
 
         try:
-            exec 'repr_name = self.%s["name"]' % (self.collection[:-1])
+            repr_name = getattr(self, self.collection[:-1])["name"]
         except:
             self.logger.warn("UserAsset object has no 'name' attribute!")
             repr_name = "UNKNOWN"
         return "%s object '%s' [%s]" % (self.collection, repr_name, self._id)
 
 
-    def __init__(self, collection=None, _id=None, normalize_on_init=True, new_asset_attribs={}, Settlement=None):
+    def __init__(self, collection=None, _id=None, normalize_on_init=True, new_asset_attribs={}, Settlement=None, write_buffer=None):
 
         # initialize basic vars
         self.logger = utils.get_logger()
@@ -486,15 +792,20 @@ class UserAsset():
         # use attribs to determine whether the object has been loaded
         self.loaded = False
 
+        # if we're initializing with a settlement object already in memory, use it
+        # (and its write buffer, if it's got one, e.g. because it's in its own
+        # new() method, creating us). Callers that want all of our writes kept
+        # out of the mdb (e.g. migrations.py) can hand us a buffer directly.
+        self.Settlement = Settlement
+        if write_buffer is None:
+            write_buffer = getattr(Settlement, "write_buffer", None)
+        self.write_buffer = write_buffer
+
         if _id is None:
             self.get_request_params()
             self.new()
             _id = self._id
 
-        # if we're initializing with a settlement object already in memory, use it
-        # if this object IS a Settlement, the load() call below will overwrite this
-        self.Settlement = Settlement
-
         # now do load() stuff
         try:
             try:
@@ -513,7 +824,21 @@ class UserAsset():
 
     def save(self, verbose=True):
         """ Saves the user asset back to either the 'survivors' or 'settlements'
-        collection in mdb, depending on self.collection. """
+        collection in mdb, depending on self.collection.
+
+        Settlements and survivors that were normalized (or found to be
+        normalized) when they were loaded get their normalization stamp
+        refreshed first, so that the next load can skip normalize().
+
+        Objects with an active write buffer save to the buffer instead (see
+        WriteBuffer, above). """
+
+        if getattr(self, "normalized", False):
+            self.stamp_normalization()
+
+        if self.buffering():
+            self.write_buffer.save(self.collection, getattr(self, self.collection[:-1]))
+            return True
 
         if self.collection == "settlements":
             utils.mdb.settlements.save(self.settlement)
@@ -521,6 +846,7 @@ class UserAsset():
             utils.mdb.survivors.save(self.survivor)
         elif self.collection == "users":
             utils.mdb.users.save(self.user)
+            user_directory.update(self.user)
         else:
             raise AssetLoadError("Invalid MDB collection for this asset!")
         if verbose:
@@ -553,6 +879,99 @@ class UserAsset():
 
 
 
+    #
+    #   normalization fast path
+    #
+
+    def get_normalization_hash(self):
+        """ Returns a sha1 of the asset's mdb document (minus its own
+        normalization hash). Normalization touches nearly every key in a
+        settlement or survivor document, so we hash the whole thing.
+
+        We hash the BSON encoding (which is done in C) rather than sorted JSON:
+        mdb keeps key order, so an unchanged document always hashes the same,
+        and a document whose keys got shuffled just gets normalized again. """
+
+        doc = copy(getattr(self, self.collection[:-1]))
+        doc["meta"] = copy(doc.get("meta", {}))
+        doc["meta"].pop("normalization_hash", None)
+        return hashlib.sha1(BSON.encode(doc)).hexdigest()
+
+
+    def stamp_normalization(self):
+        """ Stamps the asset's document with the running code's schema version
+        and a hash of its contents. Returns True if the stamp changed.
+
+        The version goes on first, so that it's part of what gets hashed (and
+        so that is_normalized() agrees with us on the next load). """
+
+        meta = getattr(self, self.collection[:-1])["meta"]
+        old_stamp = (meta.get("schema_version", None), meta.get("normalization_hash", None))
+        meta["schema_version"] = self.schema_version
+        meta["normalization_hash"] = self.get_normalization_hash()
+        return old_stamp != (meta["schema_version"], meta["normalization_hash"])
+
+
+    def is_normalized(self):
+        """ Returns True if the asset's document was stamped by the running
+        code's normalize() (or save()) and hasn't been changed since (e.g. by
+        the legacy app, which doesn't stamp anything).
+
+        The schema version check is free, so we do that first and only hash
+        the document if it passes. """
+
+        meta = getattr(self, self.collection[:-1]).get("meta", {})
+        if meta.get("schema_version", None) != self.schema_version:
+            return False
+        if meta.get("normalization_hash", None) is None:
+            return False
+        return meta["normalization_hash"] == self.get_normalization_hash()
+
+
+    def normalize_if_stale(self):
+        """ Calls self.normalize() unless the document is already normalized
+        (see is_normalized() above). Records what happened either way.
+
+        Skipping normalize() only skips the parts of it that depend on the
+        document itself: normalize_cross_document() runs no matter what. """
+
+        if self.is_normalized():
+            self.normalized = True
+            self.record_normalization("skipped")
+            self.normalize_cross_document()
+        else:
+            self.normalize()
+            self.record_normalization("normalized")
+
+
+    def normalize_cross_document(self):
+        """ Override this with any normalization that depends on OTHER mdb
+        documents, e.g. settlement minimums that come from its survivors.
+        Changes to those don't change this document's hash, so this gets
+        called on every load. Does nothing by default. """
+
+        return False
+
+
+    def record_normalization(self, outcome):
+        """ Tallies a normalization 'outcome' ('skipped' or 'normalized') for
+        the asset's collection and flushes the tally to mdb.normalization_stats
+        every settings.api.normalization_stats_interval seconds. """
+
+        counts = normalization_stats["counts"].setdefault(self.collection, {"skipped": 0, "normalized": 0})
+        counts[outcome] += 1
+
+        interval = timedelta(seconds=settings.get("api","normalization_stats_interval"))
+        if datetime.now() - normalization_stats["since"] < interval:
+            return False
+
+        for collection, counts in normalization_stats["counts"].iteritems():
+            utils.mdb.normalization_stats.update({"_id": collection}, {"$inc": counts}, upsert=True)
+        normalization_stats["counts"] = {}
+        normalization_stats["since"] = datetime.now()
+        return True
+
+
     def return_json(self):
         """ Calls the asset's serialize() method and creates a simple HTTP
         response. """
@@ -672,6 +1091,13 @@ class UserAsset():
         return output
 
 
+    def buffering(self):
+        """ Returns True if the object's writes are going into an active
+        WriteBuffer instead of the mdb. """
+
+        return getattr(self, "write_buffer", None) is not None and self.write_buffer.active
+
+
     def get_current_ly(self):
         """ Convenience/legibility function to help code readbility and reduce
         typos, etc. """
@@ -685,13 +1111,18 @@ class UserAsset():
         """ Retrieves the asset's MDB document. Raises a special exception if it
         cannot for some reason. """
 
+        if self.buffering():
+            mdb_doc = self.write_buffer.get(self.collection, self._id)
+            if mdb_doc is not None:
+                return mdb_doc
+
         mdb_doc = utils.mdb[self.collection].find_one({"_id": self._id})
         if mdb_doc is None:
             raise AssetLoadError()
         return mdb_doc
 
 
-    def list_assets(self, attrib=None, log_failures=True):
+    def list_assets(self, attrib=None, log_failures=True, records=False):
         """ Laziness method that returns a list of dictionaries where dictionary
         in the list is an asset in the object's list of those assets.
 
@@ -702,6 +1133,10 @@ class UserAsset():
         Same goes for settlements: if you set 'attrib' to 'locations', you get
         a list where each item is a location asset dict.
 
+        Set 'records' to True to get a list of (shared, read-only) AssetRecord
+        objects instead of dict copies. This is a lot cheaper, so if all you're
+        going to do is look at them, do that.
+
         Important! This ignores unregistered/unknown/bogus items! Anything that
         cannot be looked up by its handle or name is ignored!
         """
@@ -712,12 +1147,24 @@ class UserAsset():
             raise Exception(msg)
 
         output = []
-        if attrib == "principles":
-            A = models.innovations.Assets()
-        else:
-            exec "A = models.%s.Assets()" % attrib
-        exec "asset_list = self.%s['%s']" % (self.collection[:-1], attrib)
-
+        asset_list = getattr(self, self.collection[:-1])[attrib]
+
+        if records:
+            by_handle = get_asset_records(attrib)
+            A = None
+            for a in asset_list:
+                record = by_handle.get(a, None)
+                if record is None:
+                    if A is None:
+                        A = get_asset_collection(attrib)
+                    record = A.get_record(a, backoff_to_name=True, raise_exception_if_not_found=False)
+                if record is not None:
+                    output.append(record)
+                elif log_failures:
+                    self.logger.error("%s Unknown '%s' asset '%s' cannot be listed!" % (self, attrib, a))
+            return output
+
+        A = get_asset_collection(attrib)
         for a in asset_list:
             a_dict = A.get_asset(a, backoff_to_name=True, raise_exception_if_not_found=False)
             if a_dict is not None:
@@ -747,7 +1194,10 @@ class UserAsset():
             "event": msg,
             "event_type": event_type,
         }
-        utils.mdb.settlement_events.insert(d)
+        if self.buffering():
+            self.write_buffer.insert("settlement_events", d)
+        else:
+            utils.mdb.settlement_events.insert(d)
         self.logger.debug("%s event: %s" % (self, msg))
 
 
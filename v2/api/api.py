@@ -16,13 +16,14 @@ import os
 from pprint import pprint
 
 # application-specific imports
+import catalogs
 import request_broker
 import settings
 import world
 import utils
 
 # models
-from models import users, settlements, names
+from models import users, names
 
 
 # general logging
@@ -42,6 +43,9 @@ application.config['SECRET_KEY'] = settings.get("api","secret_key","private")
 #   Javascript Web Token! DO NOT import jwt (i.e. pyjwt) here!
 jwt = flask_jwt_extended.JWTManager(application)
 
+# public game asset catalogs get rendered once, right here (see catalogs.py)
+catalogs.render()
+
 
 #
 #   Routes start here! Settings object initialized above...
@@ -71,6 +75,22 @@ def monster_json():
 def campaign_json():
     return request_broker.get_game_asset("campaign")
 
+@application.route("/monster/<handle>")
+@utils.crossdomain(origin=['*'],headers='Content-Type')
+def monster_catalog_json(handle):
+    blob = catalogs.get_blob("monster", handle)
+    if blob is None:
+        return utils.http_404
+    return catalogs.blob_response(blob)
+
+@application.route("/campaign/<handle>")
+@utils.crossdomain(origin=['*'],headers='Content-Type')
+def campaign_catalog_json(handle):
+    blob = catalogs.get_blob("campaign", handle)
+    if blob is None:
+        return utils.http_404
+    return catalogs.blob_response(blob)
+
 @application.route("/settings.json")
 def get_settings_json():
     S = settings.Settings()
@@ -88,23 +108,31 @@ def get_settings():
 @application.route("/world")
 @utils.crossdomain(origin=['*'],headers='Content-Type')
 def world_json():
-    W = world.World()
-    D = world.WorldDaemon()
-    d = {"world_daemon": D.dump_status(dict)}
-    d.update(W.list(dict))
-    j = json.dumps(d, default=json_util.default)
-    response = Response(response=j, status=200, mimetype="application/json")
-    return response
+    """ Serves the pre-rendered snapshot published by the world daemon. """
+
+    snapshot = world.get_snapshot()
+    headers = {
+        "ETag": '"%s"' % snapshot["etag"],
+        "Cache-Control": "public, max-age=%s" % settings.get("world","snapshot_max_age"),
+        "Vary": "Accept-Encoding",
+    }
+
+    if snapshot["etag"] in request.if_none_match:
+        return Response(status=304, headers=headers)
+
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        body = str(snapshot["gzip"])
+    else:
+        body = snapshot["json"]
+
+    return Response(response=body, status=200, mimetype="application/json", headers=headers)
 
 @application.route("/new_settlement")
 @utils.crossdomain(origin=['*'],headers='Content-Type')
 def get_new_settlement_assets():
-    S = settlements.Assets()
-    return Response(
-        response=json.dumps(S.serialize(), default=json_util.default),
-        status=200,
-        mimetype="application/json"
-    )
+    """ Serves the pre-rendered new settlement catalog (see catalogs.py). """
+    return catalogs.blob_response(catalogs.catalogs["new_settlement"])
 
 @application.route("/get_random_names/<count>")
 @utils.crossdomain(origin=['*'],headers='Content-Type')
@@ -175,6 +203,8 @@ def refresh_auth(action):
             return utils.http_401
     elif action == "check":
         return users.check_authorization(auth)
+    elif action == "logout":
+        return users.revoke_token(auth)
     else:
         return utils.http_402
 
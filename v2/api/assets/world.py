@@ -5,6 +5,33 @@
 # local imports
 import utils
 
+
+#
+#   Each dict in 'general' below is a world stat. In addition to the usual
+#   'name', 'comment', 'max_age' (in minutes!) and 'limit' keys, stats may
+#   declare any of the following registry keys (see world.World.get_stat()):
+#
+#       'collection':   the mdb collection the stat is computed from
+#       'pipeline':     an aggregation pipeline (run against 'collection') that
+#                       returns one document with a 'value' key. Stats with a
+#                       pipeline don't need a World method: they get batched
+#                       with the other stale stats from their collection into
+#                       one $facet query.
+#       'since':        a tuple of (attrib, days): prepends a $match on
+#                       'attrib' being within 'days' of right now
+#       'default':      the value to use if 'pipeline' comes back empty
+#       'depends_on':   a list of stat handles to refresh before this one
+#       'cost':         'cheap' (default) or 'expensive'. Expensive stats are
+#                       refreshed less often during peak hours.
+#
+#   Registry keys are not warehoused and do not show up in /world output.
+#
+
+registry_keys = ["collection", "pipeline", "since", "default", "depends_on", "cost"]
+
+count_stage = {"$group": {"_id": None, "value": {"$sum": 1}}}
+
+
 general = {
     "api_response_times": {
         "name": "API Request Response Times",
@@ -32,6 +59,7 @@ general = {
         "comment": "worldwide count of all settlements, regardless of status",
     },
     "active_settlements": {
+        "depends_on": ["total_settlements", "abandoned_settlements"],
         "name": "Active settlements",
         "comment": "worldwide count of all settlements that have not been abandoned or removed"
     },
@@ -40,24 +68,44 @@ general = {
         "comment": "worldwide count of all abandoned settlements",
     },
     "removed_settlements": {
+        "collection": "settlements",
+        "pipeline": [{"$match": {"removed": {"$exists": True}}}, count_stage],
+        "default": 0,
         "name": "Removed settlements",
         "comment": "worldwide count of all removed settlements",
     },
     "abandoned_or_removed_settlements": {
+        "collection": "settlements",
+        "pipeline": [
+            {"$match": {"$or": [{"removed": {"$exists": True}}, {"abandoned": {"$exists": True}}]}},
+            count_stage,
+        ],
+        "default": 0,
         "name": "Abandoned or removed settlements",
         "comment": "Application-wide count of all abandoned or removed settlements (does not double-dip)",
     },
     "total_users": {
+        "collection": "users",
+        "pipeline": [count_stage],
+        "default": 0,
         "max_age": 30,
         "name": "Total users",
         "comment": "total of all registered users"
     },
     "total_users_last_30": {
+        "collection": "users",
+        "since": ("latest_activity", 30),
+        "pipeline": [count_stage],
+        "default": 0,
         "max_age": 60,
         "name": "Total users in the last 30 days",
         "comment": "total of all users who have signed in during the last 30 days"
     },
     "new_settlements_last_30": {
+        "collection": "settlements",
+        "since": ("created_on", 30),
+        "pipeline": [count_stage],
+        "default": 0,
         "max_age": 60,
         "name": "Total settlements created in the last 30 days",
         "comment": "total of all settlements with a 'created_on' date within the last 30 days"
@@ -68,118 +116,142 @@ general = {
         "comment": "Total of all sessions within the 'recent_session' horizon"
     },
     "max_pop": {
+        "cost": "expensive",
         "name": "Maximum population",
         "comment": "highest population across all settlements",
     },
     "max_death_count": {
+        "cost": "expensive",
         "name": "Maximum death count",
         "comment": "highest death count across all settlements",
     },
     "max_survival_limit": {
+        "cost": "expensive",
         "name": "Maximum Survival Limit",
         "comment": "highest survival limit across all settlements",
     },
     "avg_ly": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Lantern Year",
         "comment": "average ly across all settlements",
     },
     "avg_lost_settlements": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Lost Settlements",
         "comment": "average number of lost settlements across all settlements",
     },
     "avg_pop": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Population",
         "comment": "average population across all settlements",
     },
     "avg_death_count": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Death Count",
         "comment": "average death count across all settlements",
     },
     "avg_survival_limit": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Survival Limit",
         "comment": "average survival limit across all settlements",
     },
     "avg_milestones": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average milestone story events",
         "comment": "average number of milestone story events across all settlements",
     },
     "avg_storage": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average items in Settlement Storage",
         "comment": "average number of items in settlement storage across all settlements",
     },
     "avg_defeated_monsters": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average defeated monsters",
         "comment": "average number of defeated monsters across all settlements",
     },
     "avg_expansions": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average number of active expansions",
         "comment": "average number of active expansion modules across all settlements",
     },
     "avg_innovations": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Innovations",
         "comment": "average number of innovations across all settlements",
     },
     "avg_disorders": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Disorders",
         "comment": "average number of disorders per survivor across all survivors",
     },
     "avg_abilities": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Abilities and Impairments",
         "comment": "average number of abilities and impairments per survivor across all survivors",
     },
     "avg_hunt_xp": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Hunt XP",
         "comment": "average hunt xp per survivor across all survivors",
     },
     "avg_insanity": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Insanity",
         "comment": "average insanity per survivor across all survivors",
     },
     "avg_courage": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Courage",
         "comment": "average courage per survivor across all survivors",
     },
     "avg_understanding": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Understanding",
         "comment": "average understanding per survivor across all survivors",
     },
     "avg_fighting_arts": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Fighting Arts",
         "comment": "average number of fighting arts per survivor across all survivors",
     },
     "avg_user_settlements": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Settlements per user",
         "comment": "average number of settlements created per user across all users",
     },
     "avg_user_survivors": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Average Survivors per user",
         "comment": "average number of survivors created per user across all users",
     },
     "avg_user_avatars": {
+        "cost": "expensive",
         "max_age": 30,
         "name": "Average avatars per user",
         "comment": "average number of avatars uploaded per user across all users",
     },
     "total_multiplayer_settlements": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Total multiplayer settlements",
         "comment": "total number of settlements with more than one player",
@@ -188,6 +260,12 @@ general = {
         "name": "Kill Board",
         "comment": "Monster kills logged by all settlements",
     },
+    "killboard_last_7": {
+        "cost": "expensive",
+        "max_age": 60,
+        "name": "Kill Board: last 7 days",
+        "comment": "Monster kills logged by all settlements during the last seven days",
+    },
     "latest_kill": {
         "max_age": 3,
         "name": "Latest kill",
@@ -209,48 +287,72 @@ general = {
         "comment": "Most recently created settlement",
     },
     "top_survivor_names": {
+        "cost": "expensive",
         "max_age": 30,
         "name": "Top Survivor names",
         "comment": "Most popular survivor names across all settlements",
         "limit": 10,
     },
     "top_settlement_names": {
+        "cost": "expensive",
         "max_age": 30,
         "name": "Top Settlement names",
         "comment": "Most popular survivor names across all settlements",
         "limit": 10,
     },
     "top_causes_of_death": {
+        "cost": "expensive",
         "max_age": 30,
         "name": "Top causes of death",
         "comment": "Most popular causes of survivor death across all settlements",
     },
     "top_innovations": {
+        "cost": "expensive",
         "max_age": 30,
         "limit": 10,
         "name": "Popularity contest: innovations",
         "comment": "Top innovations by frequency across all settlements",
     },
     "principle_selection_rates": {
+        "cost": "expensive",
         "max_age": 60,
         "name": "Principle selection rates",
         "comment": "Principle selection rates across all settlements",
     },
     "settlement_popularity_contest_expansions": {
+        "cost": "expensive",
         "max_age": 30,
         "name": "Popularity contest: expansions",
         "comment": "Number of settlements where each available expansion module is enabled",
     },
     "settlement_popularity_contest_campaigns": {
+        "cost": "expensive",
         "max_age": 30,
         "name": "Popularity contest: campaigns",
         "comment": "Number of settlements where each different campaign is enabled",
     },
+    "normalization_skip_rate": {
+        "collection": "normalization_stats",
+        "pipeline": [
+            {"$group": {"_id": None, "skipped": {"$sum": "$skipped"}, "normalized": {"$sum": "$normalized"}}},
+            {"$project": {"value": {"$multiply": [
+                100, {"$divide": ["$skipped", {"$add": ["$skipped", "$normalized"]}]},
+            ]}}},
+        ],
+        "max_age": 30,
+        "name": "Normalization skip rate",
+        "comment": "Percentage of settlement and survivor loads that skipped normalize() because the document was already current",
+    },
     "current_hunt": {
         "max_age": 3,
         "name": "Current hunt",
         "comment": "Info on the most recent group of Departing Survivors.",
     },
+    "current_hunts": {
+        "max_age": 3,
+        "name": "Current hunts",
+        "comment": "Info on the most recent groups of Departing Survivors.",
+    },
 
 }
 
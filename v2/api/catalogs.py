@@ -0,0 +1,113 @@
+#!/usr/bin/python2.7
+
+#
+#   Catalogs: the public, read-only game asset JSON that anonymous users (and
+#   the webapp's landing/new settlement pages) hit all day long, i.e. the
+#   '/new_settlement' options and the '/monster' and '/campaign' definitions.
+#
+#   None of that changes unless we deploy, so each API worker renders all of
+#   it exactly once, at start-up (see render()), into pre-encoded JSON blobs
+#   and serves those. Every blob has a content hash that we use as its ETag.
+#   The URLs don't change when we deploy, so responses are 'no-cache': clients
+#   (and proxies) keep their copy, but revalidate it on every request, which
+#   costs them a 304 until the catalog actually changes.
+#
+#   Blobs are dicts that look like this:
+#
+#       {'etag': <sha1 of the JSON>, 'json': <str>, 'gzip': <str>}
+#
+#   YHBW
+#
+
+from cStringIO import StringIO
+from datetime import datetime
+import gzip
+import hashlib
+import json
+
+from bson import json_util
+from flask import request, Response
+
+import utils
+from models import campaigns, monsters, settlements
+
+logger = utils.get_logger()
+
+# the big one: populated by render()
+catalogs = {
+    "rendered_on": None,
+    "new_settlement": None,
+    "monster": {},          # handle -> blob
+    "campaign": {},         # handle -> blob
+    "names": {"monster": {}, "campaign": {}},  # upper-case name -> handle
+}
+
+
+def make_blob(output):
+    """ Takes a JSON string and returns a blob dict, i.e. with a content hash
+    and a gzipped version of the JSON. """
+
+    buf = StringIO()
+    z = gzip.GzipFile(fileobj=buf, mode="wb")
+    z.write(output)
+    z.close()
+
+    return {
+        "etag": hashlib.sha1(output).hexdigest(),
+        "json": output,
+        "gzip": buf.getvalue(),
+    }
+
+
+def render():
+    """ Renders every catalog. Call this once, when the worker starts. """
+
+    S = settlements.Assets()
+    catalogs["new_settlement"] = make_blob(json.dumps(S.serialize(), default=json_util.default))
+
+    for collection, A in [("monster", monsters.Assets()), ("campaign", campaigns.Assets())]:
+        for handle in A.get_handles():
+            try:
+                catalogs[collection][handle] = make_blob(A.AssetClass(handle).serialize())
+            except Exception as e:
+                logger.error("Could not render '%s' catalog entry for '%s'!" % (collection, handle))
+                logger.exception(e)
+                continue
+            name = A.get_asset(handle).get("name", None)
+            if name is not None:
+                catalogs["names"][collection][name.upper()] = handle
+
+    catalogs["rendered_on"] = datetime.now()
+    logger.info("Rendered catalogs: %s monsters, %s campaigns." % (len(catalogs["monster"]), len(catalogs["campaign"])))
+
+
+def get_blob(collection, handle=None, name=None):
+    """ Returns the blob for a monster or campaign handle (or name, but only
+    if it's an exact, case-insensitive match). Returns None if we haven't
+    got one. """
+
+    if handle is None and name is not None:
+        handle = catalogs["names"][collection].get(name.strip().upper(), None)
+    return catalogs[collection].get(handle, None)
+
+
+def blob_response(blob):
+    """ Turns a blob into a flask Response with caching headers. Returns a 304
+    if the client already has it and gzips if the client will take it. """
+
+    headers = {
+        "ETag": '"%s"' % blob["etag"],
+        "Cache-Control": "public, no-cache",
+        "Vary": "Accept-Encoding",
+    }
+
+    if blob["etag"] in request.if_none_match:
+        return Response(status=304, headers=headers)
+
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        body = blob["gzip"]
+    else:
+        body = blob["json"]
+
+    return Response(response=body, status=200, mimetype="application/json", headers=headers)
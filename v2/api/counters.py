@@ -0,0 +1,116 @@
+#!/usr/bin/python2.7
+
+#
+#   Incremental counters for world stats. The API bumps these as things happen
+#   (survivors are born and die, settlements get created and abandoned,
+#   monsters get killed, etc.) so that world.py doesn't have to count every
+#   document in a collection (or, in the case of the killboard, iterate over
+#   every document in a collection) every time it refreshes.
+#
+#   Counters live in mdb.world_counters and are reconciled against the full
+#   queries every so often by the world daemon (see reconcile() below), so if
+#   an increment ever gets missed, it won't stay missed for long.
+#
+
+from datetime import datetime, timedelta
+
+import settings
+import utils
+
+logger = utils.get_logger()
+
+
+# these are the full queries that the counters are reconciled against: keys
+#   are counter names, values are (collection, query) tuples
+queries = {
+    "total_survivors":          ("survivors", {}),
+    "live_survivors":           ("survivors", {"dead": {"$exists": False}}),
+    "dead_survivors":           ("survivors", {"dead": {"$exists": True}}),
+    "total_settlements":        ("settlements", {}),
+    "abandoned_settlements":    ("settlements", {"abandoned": {"$exists": True}}),
+}
+
+
+def increment(counter, amount=1):
+    """ Adds 'amount' to 'counter'. Use a negative 'amount' to decrement.
+
+    Counters that have never been reconciled are left alone: their first
+    value has to come from the full query, or we'd just be counting from
+    zero. """
+
+    if counter not in queries:
+        raise utils.InvalidUsage("'%s' is not a known world counter!" % counter)
+
+    utils.mdb.world_counters.update(
+        {"_id": counter},
+        {"$inc": {"value": amount}},
+    )
+
+
+def increment_kill(monster_type, monster_handle):
+    """ Bumps the killboard counter for one monster. """
+
+    utils.mdb.world_counters.update(
+        {"_id": "killboard"},
+        {"$inc": {"value.%s.%s" % (monster_type, monster_handle): 1}},
+    )
+
+
+def get(counter):
+    """ Returns the current value of 'counter', reconciling it first if it
+    hasn't got one yet. """
+
+    doc = utils.mdb.world_counters.find_one({"_id": counter})
+    if doc is None:
+        return reconcile_one(counter)
+    return doc["value"]
+
+
+def reconcile_one(counter):
+    """ Recomputes one counter from its full query, saves it and returns the
+    new value. Logs a warning if the counter had drifted. """
+
+    if counter == "killboard":
+        value = {}
+        results = utils.mdb.killboard.aggregate([
+            {"$match": {"handle": {"$exists": True}, "type": {"$exists": True}}},
+            {"$group": {"_id": {"type": "$type", "handle": "$handle"}, "count": {"$sum": 1}}},
+        ])
+        for r in results:
+            value.setdefault(r["_id"]["type"], {})[r["_id"]["handle"]] = r["count"]
+    else:
+        collection, query = queries[counter]
+        value = utils.mdb[collection].find(query).count()
+
+    doc = utils.mdb.world_counters.find_one({"_id": counter})
+    if doc is not None and doc["value"] != value:
+        logger.warn("World counter '%s' had drifted! Reconciled to %s." % (counter, value))
+
+    utils.mdb.world_counters.update(
+        {"_id": counter},
+        {"$set": {"value": value, "reconciled_on": datetime.now()}},
+        upsert=True,
+    )
+    return value
+
+
+def reconcile(force=False):
+    """ Reconciles all counters, if it has been more than
+    settings.world.counter_reconcile_interval minutes since the last time we
+    did it (or if 'force' is True). """
+
+    all_counters = queries.keys() + ["killboard"]
+    interval = timedelta(minutes=settings.get("world","counter_reconcile_interval"))
+
+    if not force:
+        docs = list(utils.mdb.world_counters.find({"_id": {"$in": all_counters}}, {"reconciled_on": 1}))
+        if len(docs) == len(all_counters):
+            oldest = min([d["reconciled_on"] for d in docs])
+            if datetime.now() - oldest < interval:
+                return False
+
+    logger.info("Reconciling world counters...")
+    for counter in all_counters:
+        reconcile_one(counter)
+    return True
+
@@ -0,0 +1,153 @@
+#!/usr/bin/python2.7
+
+#
+#   Live activity: a small, TTL-indexed collection of hunts that are going on
+#   right now. Settlements write to it when they set a quarry, set a showdown
+#   type or change their Departing Survivors, and remove themselves from it
+#   when their survivors return, so the world's current hunt feed is one
+#   indexed query instead of a scan of mdb.settlements plus a survivors query
+#   per settlement.
+#
+#   Documents in mdb.live_activity look like this:
+#
+#       {
+#           '_id': <settlement ObjectId>,
+#           'hunt_started': <datetime>,
+#           'updated_on': <datetime>,
+#           'settlement': {'_id', 'name', 'lantern_year', 'current_quarry', ...},
+#           'survivors': [{'_id', 'name', 'sex'}, ...],
+#       }
+#
+#   The mdb drops them on its own settings.world.live_activity_ttl minutes
+#   after 'hunt_started', so abandoned hunts don't stick around forever.
+#   Hunts from removed settlements get dropped (and cleaned up) on read.
+#
+
+from datetime import datetime, timedelta
+
+import settings
+import utils
+
+logger = utils.get_logger()
+
+indexes = {"ensured": False}
+
+
+def ensure_indexes():
+    """ Creates the TTL index on 'hunt_started' (which is also the index we
+    use for recency) if we haven't already done it in this process. """
+
+    if indexes["ensured"]:
+        return True
+
+    utils.mdb.live_activity.create_index(
+        "hunt_started",
+        expireAfterSeconds=settings.get("world","live_activity_ttl") * 60,
+    )
+    indexes["ensured"] = True
+    return True
+
+
+def get_hunting_party(settlement_id):
+    """ Returns a list of the settlement's living Departing Survivors,
+    trimmed down to what the live feed needs. """
+
+    return list(utils.mdb.survivors.find(
+        {"settlement": settlement_id, "departing": True, "dead": {"$exists": False}},
+        {"name": 1, "sex": 1},
+    ).sort("name"))
+
+
+def start_hunt(settlement):
+    """ Takes a settlement dict (i.e. Settlement.settlement) that has just had
+    its quarry set and (re)writes its live activity document. """
+
+    ensure_indexes()
+
+    utils.mdb.live_activity.save({
+        "_id": settlement["_id"],
+        "hunt_started": settlement["hunt_started"],
+        "updated_on": datetime.now(),
+        "settlement": {
+            "_id": settlement["_id"],
+            "name": settlement["name"],
+            "lantern_year": settlement.get("lantern_year", 0),
+            "current_quarry": settlement["current_quarry"],
+            "showdown_type": settlement.get("showdown_type", "normal"),
+            "hunt_started": settlement["hunt_started"],
+        },
+        "survivors": get_hunting_party(settlement["_id"]),
+    })
+
+
+def update_hunt(settlement_id, showdown_type=None):
+    """ Refreshes the hunting party (and the showdown type, if it's not None)
+    of a settlement that is already hunting. Does nothing for settlements
+    that aren't. """
+
+    update = {"survivors": get_hunting_party(settlement_id), "updated_on": datetime.now()}
+    if showdown_type is not None:
+        update["settlement.showdown_type"] = showdown_type
+
+    utils.mdb.live_activity.update({"_id": settlement_id}, {"$set": update})
+
+
+def end_hunt(settlement_id):
+    """ Removes a settlement's live activity document. """
+
+    utils.mdb.live_activity.remove({"_id": settlement_id})
+
+
+def drop_removed(hunts):
+    """ Takes a list of live activity docs and returns the ones whose
+    settlements haven't been removed. Settlements get removed (i.e. soft-
+    deleted) by the legacy app, which doesn't know about us, so this is also
+    where their live activity docs get cleaned up. """
+
+    if hunts == []:
+        return hunts
+
+    removed = utils.mdb.settlements.find(
+        {"_id": {"$in": [h["_id"] for h in hunts]}, "removed": {"$exists": True}},
+        {"_id": 1},
+    )
+    removed = set([s["_id"] for s in removed])
+    for settlement_id in removed:
+        end_hunt(settlement_id)
+
+    return [h for h in hunts if h["_id"] not in removed]
+
+
+def get_hunts(limit=1, ineligible_names=[]):
+    """ Returns a list of the 'limit' most recently started hunts, most recent
+    first. Each one is a dict with 'settlement' and 'survivors' keys. Hunts
+    without any survivors (or from removed settlements) are skipped. """
+
+    ensure_indexes()
+
+    cutoff = datetime.now() - timedelta(minutes=settings.get("world","live_activity_ttl"))
+    results = utils.mdb.live_activity.find(
+        {
+            "hunt_started": {"$gte": cutoff},
+            "settlement.name": {"$nin": ineligible_names},
+            "survivors": {"$ne": []},
+        },
+        {"settlement": 1, "survivors": 1},
+        sort=[("hunt_started", -1)],
+    )
+
+    # check for removed settlements a batch at a time, only reading as far
+    #   down the cursor as we have to
+    hunts = []
+    batch = []
+    for h in results:
+        batch.append(h)
+        if len(batch) >= limit - len(hunts):
+            hunts.extend(drop_removed(batch))
+            batch = []
+            if len(hunts) >= limit:
+                break
+    hunts.extend(drop_removed(batch))
+    results.close()
+
+    return [{"settlement": h["settlement"], "survivors": h["survivors"]} for h in hunts[:limit]]
@@ -0,0 +1,275 @@
+#!/usr/bin/python2.7
+
+
+from collections import Counter
+from copy import deepcopy
+from datetime import datetime
+from optparse import OptionParser
+import os
+import time
+
+from pymongo import UpdateOne
+
+import Models
+import utils
+from models import settlements, survivors
+
+
+
+#
+#   This is an admin script: it runs the same normalize() migrations that the
+#   Settlement and Survivor objects run on the request path, except that it
+#   does it offline, in batches, with bulk writes.
+#
+#   Every document that comes out of normalize() gets stamped with its
+#   model's 'schema_version', so documents that have been migrated don't
+#   need to be normalized again (and can be skipped by the runner).
+#
+#   Progress is checkpointed to mdb.migrations after every batch, so if a run
+#   dies (or gets killed), the next one picks up where it left off. Documents
+#   that blow up get retried at the start of the next run.
+#
+#   Models get loaded with a Models.WriteBuffer, so anything normalize() writes
+#   on the side (settlement events, settlement notes, etc.) gets written with
+#   the batch, or not at all if it's a dry run. Settlements get loaded without
+#   their survivors (which get migrated on their own, after all).
+#
+#   YHBW
+#
+
+models = {
+    "settlements": (settlements.Settlement, settlements.schema_version),
+    "survivors": (survivors.Survivor, survivors.schema_version),
+}
+
+# extra kwargs for initializing each model
+model_kwargs = {
+    "settlements": {"load_survivors": False},
+    "survivors": {},
+}
+
+
+class MigrationRunner:
+    """ Initialize one of these with a collection name ('settlements' or
+    'survivors') and call its run() method. """
+
+    def __init__(self, collection=None, batch_size=100, dry_run=False):
+        if collection not in models.keys():
+            raise utils.InvalidUsage("Cannot migrate '%s'! Collection must be one of %s" % (collection, models.keys()))
+
+        self.logger = utils.get_logger()
+        self.collection = collection
+        self.model, self.schema_version = models[collection]
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.changed_keys = Counter()
+        self.write_buffer = Models.WriteBuffer()
+
+
+    def get_checkpoint(self):
+        """ Returns the collection's checkpoint doc from mdb.migrations, or a
+        fresh one if there isn't one (or if the one there is for an older
+        schema version). """
+
+        checkpoint = utils.mdb.migrations.find_one({"_id": self.collection})
+        if checkpoint is None or checkpoint["schema_version"] != self.schema_version:
+            checkpoint = {
+                "_id": self.collection,
+                "schema_version": self.schema_version,
+                "last_id": None,
+                "processed": 0,
+                "modified": 0,
+                "failed": [],
+                "started_on": datetime.now(),
+            }
+        return checkpoint
+
+
+    def reset(self):
+        """ Drops the collection's checkpoint, so the next run starts over. """
+        utils.mdb.migrations.remove({"_id": self.collection})
+        self.logger.warn("Removed mdb.migrations checkpoint for '%s'!" % self.collection)
+
+
+    def migrate_one(self, _id):
+        """ Runs normalize() on one document without saving it. Returns an
+        UpdateOne request for whatever changed, or None if nothing did. """
+
+        M = self.model(
+            _id=_id,
+            normalize_on_init=False,
+            write_buffer=self.write_buffer,
+            **model_kwargs[self.collection]
+        )
+        doc = getattr(M, self.collection[:-1])
+        before = deepcopy(doc)
+
+        M.normalize(save=False)
+        if not M.perform_save:
+            return None
+
+        set_keys = {}
+        unset_keys = {}
+        for k in set(before.keys()) | set(doc.keys()):
+            if k not in doc:
+                unset_keys[k] = ""
+            elif before.get(k, None) != doc[k]:
+                set_keys[k] = doc[k]
+            else:
+                continue
+            self.changed_keys[k] += 1
+
+        update = {}
+        if set_keys != {}:
+            update["$set"] = set_keys
+        if unset_keys != {}:
+            update["$unset"] = unset_keys
+        if update == {}:
+            return None
+        return UpdateOne({"_id": _id}, update)
+
+
+    def run(self):
+        """ Walks the collection in _id order, starting after the checkpoint,
+        and migrates everything that isn't at the current schema version. """
+
+        checkpoint = self.get_checkpoint()
+        start = time.time()
+        self.logger.info("Migrating %s to schema version %s (dry run: %s)..." % (self.collection, self.schema_version, self.dry_run))
+
+        # retry whatever failed last time first; anything that fails again
+        #   goes right back on the list
+        retries = checkpoint["failed"]
+        checkpoint["failed"] = []
+        if retries != []:
+            self.logger.info("Retrying %s failed %s..." % (len(retries), self.collection))
+            self.migrate_batch(retries, checkpoint, start, advance=False)
+
+        query = {"meta.schema_version": {"$ne": self.schema_version}}
+        if checkpoint["last_id"] is not None:
+            query["_id"] = {"$gt": checkpoint["last_id"]}
+
+        cursor = utils.mdb[self.collection].find(query, {"_id": 1}, no_cursor_timeout=True).sort("_id", 1)
+
+        try:
+            batch = []
+            for d in cursor:
+                batch.append(d["_id"])
+                if len(batch) == self.batch_size:
+                    self.migrate_batch(batch, checkpoint, start)
+                    batch = []
+            self.migrate_batch(batch, checkpoint, start)
+        finally:
+            cursor.close()
+
+        checkpoint["finished_on"] = datetime.now()
+        if not self.dry_run:
+            utils.mdb.migrations.save(checkpoint)
+
+        return checkpoint
+
+
+    def migrate_batch(self, ids, checkpoint, start, advance=True):
+        """ Migrates a list of _ids and writes the batch. Failed _ids go on
+        the checkpoint's 'failed' list (to be retried next run). Set 'advance'
+        to False to leave the checkpoint's 'last_id' alone, e.g. for retries.
+        """
+
+        updates = []
+        for _id in ids:
+            try:
+                update = self.migrate_one(_id)
+            except Exception as e:
+                self.logger.error("Could not migrate %s _id '%s'!" % (self.collection, _id))
+                self.logger.exception(e)
+                checkpoint["failed"].append(_id)
+                update = None
+
+            if update is not None:
+                updates.append(update)
+            checkpoint["processed"] += 1
+            if advance:
+                checkpoint["last_id"] = _id
+
+        self.write_batch(updates, checkpoint, start)
+
+
+    def write_batch(self, batch, checkpoint, start):
+        """ Flushes the write buffer, bulk-writes a batch of UpdateOne requests
+        and saves the checkpoint. Doesn't write anything in a dry run (the
+        buffer just gets thrown away). """
+
+        if not self.dry_run:
+            self.write_buffer.flush()
+            if batch != []:
+                utils.mdb[self.collection].bulk_write(batch, ordered=False)
+        self.write_buffer = Models.WriteBuffer()
+
+        checkpoint["modified"] += len(batch)
+        checkpoint["updated_on"] = datetime.now()
+
+        if not self.dry_run:
+            utils.mdb.migrations.save(checkpoint)
+
+        self.logger.info("%s: %s processed, %s modified, %s failed (%.1f docs/sec)" % (
+            self.collection,
+            checkpoint["processed"],
+            checkpoint["modified"],
+            len(checkpoint["failed"]),
+            checkpoint["processed"] / max(time.time() - start, 0.001),
+        ))
+
+
+    def dump_summary(self, checkpoint):
+        """ Prints a run summary to stdout. """
+
+        print("\n\t%s (schema version %s)%s:\n" % (self.collection, self.schema_version, " DRY RUN" if self.dry_run else ""))
+        for k in ["processed", "modified", "last_id", "started_on", "updated_on", "finished_on"]:
+            utils.cli_dump(k, 20, checkpoint.get(k, None))
+        utils.cli_dump("failed", 20, len(checkpoint["failed"]))
+        if self.changed_keys != Counter():
+            print("\n\tChanged keys:\n")
+            for k, count in self.changed_keys.most_common():
+                utils.cli_dump(k, 20, count)
+        print("")
+
+
+def dump_status():
+    """ Prints the checkpoint for each collection, plus how many of its
+    documents are behind the current schema version. """
+
+    for collection in sorted(models.keys()):
+        model, schema_version = models[collection]
+        behind = utils.mdb[collection].find({"meta.schema_version": {"$ne": schema_version}}).count()
+        print("\n\t%s (schema version %s): %s documents to go\n" % (collection, schema_version, behind))
+        checkpoint = utils.mdb.migrations.find_one({"_id": collection})
+        if checkpoint is not None:
+            for k in ["schema_version", "processed", "modified", "last_id", "started_on", "updated_on", "finished_on"]:
+                utils.cli_dump(k, 20, checkpoint.get(k, None))
+    print("")
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-c", dest="collection", default=None, help="Migrate one collection: settlements|survivors|all", metavar="survivors")
+    parser.add_option("-b", dest="batch_size", default=100, type="int", help="Documents per bulk write/checkpoint")
+    parser.add_option("-n", dest="dry_run", action="store_true", default=False, help="Dry run: migrate documents in memory but don't write anything")
+    parser.add_option("-r", dest="reset", action="store_true", default=False, help="Drop the checkpoint and start over")
+    parser.add_option("-s", dest="status", action="store_true", default=False, help="Show migration status")
+    (options, args) = parser.parse_args()
+
+    if options.status:
+        dump_status()
+
+    if options.collection is not None:
+        if options.collection == "all":
+            collections = ["settlements", "survivors"]
+        else:
+            collections = [options.collection]
+
+        for collection in collections:
+            M = MigrationRunner(collection, batch_size=options.batch_size, dry_run=options.dry_run)
+            M.logger.warn("%s is migrating mdb.%s!" % (os.environ.get("USER", "UNKNOWN"), collection))
+            if options.reset:
+                M.reset()
+            M.dump_summary(M.run())
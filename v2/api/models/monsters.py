@@ -9,6 +9,7 @@ import utils
 class Assets(Models.AssetCollection):
 
     def __init__(self, *args, **kwargs):
+        self.AssetClass = Monster
         self.assets = {}
         self.assets.update(utils.AssetDict(monsters.quarries, {"type": "quarry"}))
         self.assets.update(utils.AssetDict(monsters.unique_quarries, {"type": "quarry", "unique": True}))
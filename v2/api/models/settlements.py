@@ -12,13 +12,66 @@ import random
 import socket
 import time
 
+import counters
+import live_activity
 import Models
+import user_directory
 import assets
 from models import survivors, campaigns, cursed_items, disorders, gear, endeavors, epithets, expansions, fighting_arts, weapon_specializations, weapon_masteries, causes_of_death, innovations, survival_actions, events, abilities_and_impairments, monsters, milestone_story_events, locations, causes_of_death, names, resources, storage, survivor_special_attributes, weapon_proficiency
 import settings
 import utils
 
 
+# bump this whenever normalize() learns a new migration: documents stamped with
+#   the current version have been through all of them (see migrations.py)
+schema_version = 1.0
+
+# compiled innovation dependency graphs, keyed on campaign/expansions; see the
+#   Settlement.get_innovation_graph() method
+innovation_graphs = {}
+
+# compiled storage catalogs, also keyed on campaign/expansions; see the
+#   Settlement.get_storage_catalog() method
+storage_catalogs = {}
+
+
+def build_survival_actions(SA, sa_handles, innovation_dicts, return_type=dict):
+    """ Does the work for Settlement.get_survival_actions() (and for
+    survivors.SettlementContext, which doesn't have a full Settlement to call
+    it on): 'SA' is a survival_actions.Assets(), 'sa_handles' is the campaign's
+    list of SAs and 'innovation_dicts' is the settlement's innovations as a
+    dict of asset dicts. """
+
+    # first, build the master dict based on the campaign def
+    sa_dict = {}
+    for handle in sa_handles:
+        sa_dict[handle] = SA.get_asset(handle)
+
+    # set innovations to unavailable if their availablility is not defined
+    # already within their definition:
+    for k in sa_dict.keys():
+        if not "available" in sa_dict[k]:
+            sa_dict[k]["available"] = False
+            sa_dict[k]["title_tip"] = "'%s' has not been unlocked yet." % sa_dict[k]["name"]
+
+    # second, udpate the master list to say which are available
+    for k,v in innovation_dicts.iteritems():
+        innovation_sa = v.get("survival_action", None)
+        if innovation_sa in sa_dict.keys():
+            sa_dict[innovation_sa]["available"] = True
+            sa_dict[innovation_sa]["title_tip"] = "Settlement innovation '%s' unlocks this ability." % v["name"]
+
+    # support a JSON return type:
+    if return_type=="JSON":
+        j_out = []
+        for sa_key in sa_dict.keys():
+            j_out.append(sa_dict[sa_key])
+        return sorted(j_out, key=lambda k: k['sort_order'])
+
+    # dict return
+    return sa_dict
+
+
 class Assets(Models.AssetCollection):
     """ This is a weird one, because the "Assets" that go into creating a
     settlement or working with a settlement are kind of...the whole manager.
@@ -83,12 +136,18 @@ class Settlement(Models.UserAsset):
     def __init__(self, *args, **kwargs):
         self.collection="settlements"
         self.object_version=0.72
+        self.schema_version=schema_version
+
+        # set 'load_survivors' to False to skip initializing survivors when
+        #   the settlement is loaded, e.g. for offline migrations
+        self.load_survivors = kwargs.pop("load_survivors", True)
+
         Models.UserAsset.__init__(self,  *args, **kwargs)
 
         self.init_asset_collections()
         # now normalize
         if self.normalize_on_init:
-            self.normalize()
+            self.normalize_if_stale()
 
 #        if request.User.get_preference("update_timeline"):
 #            self.update_timeline_with_story_events()
@@ -139,6 +198,11 @@ class Settlement(Models.UserAsset):
         Finally, once its initialized, we can use normal methods to apply what-
         ever other changes we need to apply (based on user params, etc.).
 
+        All of this happens in a Models.WriteBuffer: the settlement, its
+        starting survivors, their settlement_events, etc. are all built in
+        memory and then written to the mdb with a handful of bulk inserts at
+        the very end (instead of a few dozen inserts and saves along the way).
+
         """
 
         self.logger.info("%s creating a new settlement..." % request.User)
@@ -183,9 +247,12 @@ class Settlement(Models.UserAsset):
 
         #
         #   This is where we save and load(); use self.settlement from here
+        #   (everything goes into the write buffer until we flush it below)
         #
 
-        self._id = utils.mdb.settlements.insert(settlement)
+        self.write_buffer = Models.WriteBuffer()
+        self._id = self.write_buffer.insert("settlements", settlement)
+        self.write_buffer.increment("total_settlements")
         self.load() # uses self._id
 
         # set the settlement name before we save to MDB
@@ -233,6 +300,7 @@ class Settlement(Models.UserAsset):
 
         # log settlement creation and save/exit
         self.save()
+        self.write_buffer.flush()
 
 
     def new_settlement_special(self, special_handle):
@@ -270,8 +338,11 @@ class Settlement(Models.UserAsset):
         self.log_event("Automatically applied '%s' parameters." % (script["name"]))
 
 
-    def normalize(self):
-        """ Makes sure that self.settlement is up to our current standards. """
+    def normalize(self, save=True):
+        """ Makes sure that self.settlement is up to our current standards.
+
+        Set 'save' to False to leave saving to the caller (e.g. migrations.py),
+        which can check self.perform_save to see whether anything changed. """
 
         self.perform_save = False
 
@@ -326,8 +397,13 @@ class Settlement(Models.UserAsset):
         # enforce minimums
         self.enforce_minimums()
 
+        # stamp the schema version and content hash
+        self.normalized = True
+        if self.stamp_normalization():
+            self.perform_save = True
+
         # finish
-        if self.perform_save:
+        if self.perform_save and save:
             self.logger.info("%s settlement modified during normalization! Saving changes..." % self)
             self.save()
 
@@ -347,7 +423,7 @@ class Settlement(Models.UserAsset):
         # now start
         output = self.get_serialize_meta()
         output["meta"].update({
-            'creator_email': utils.mdb.users.find_one({'_id': self.settlement["created_by"]})['login'],
+            'creator_email': self.get_founder()['login'],
             'age': utils.get_time_elapsed_since(self.settlement["created_on"], units='age'),
             'player_email_list': self.get_players('email'),
         })
@@ -469,7 +545,7 @@ class Settlement(Models.UserAsset):
         """Evaluates an asset's dictionary to determine it is compatible for
         use with this settlement. Always returns a bool (no matter what). """
 
-        if type(asset_dict) != dict:
+        if type(asset_dict) != dict and not isinstance(asset_dict, Models.AssetRecord):
             asset_dict = asset_dict.__dict__
 
         # check to see if the asset excludes certian campaign types
@@ -578,6 +654,7 @@ class Settlement(Models.UserAsset):
                 killboard_dict[a] = M.get(a)
 
         utils.mdb.killboard.insert(killboard_dict)
+        counters.increment_kill(M.type, M.handle)
         self.logger.info("%s Updated the application killboard to include '%s' (%s) in LY %s" % (request.User, monster_string, M.type, self.get_current_ly()))
 
         # add it and save
@@ -916,7 +993,10 @@ class Settlement(Models.UserAsset):
             "lantern_year": n["lantern_year"],
         }
 
-        utils.mdb.settlement_notes.insert(note_dict)
+        if self.buffering():
+            self.write_buffer.insert("settlement_notes", note_dict)
+        else:
+            utils.mdb.settlement_notes.insert(note_dict)
         self.logger.info("[%s] added a settlement note to %s" % (n["author"], self))
 
 
@@ -1112,7 +1192,11 @@ class Settlement(Models.UserAsset):
         """ Abandons the settlement by setting self.settlement['abandoned'] to
         datetime.now(). Logs it. Expects a request context. """
 
+        if 'abandoned' not in self.settlement.keys():
+            counters.increment("abandoned_settlements")
+
         self.settlement['abandoned'] = datetime.now()
+        live_activity.end_hunt(self.settlement['_id'])
         self.log_event('%s abandoned the settlement!' % (request.User.login))
         self.save()
 
@@ -1285,6 +1369,7 @@ class Settlement(Models.UserAsset):
 
         # if we're still here, go ahead and save since we probably updated
         self.save()
+        live_activity.end_hunt(self.settlement['_id'])
 
         # post-processing: add 'current_survivor' effects
         if e_dict.get("current_survivor", None) is not None:
@@ -1300,6 +1385,7 @@ class Settlement(Models.UserAsset):
         self.settlement['showdown_type'] = showdown_type
         self.logger.debug("%s Set showdown type to '%s' for %s" % (request.User, showdown_type, self.Settlement))
         self.save()
+        live_activity.update_hunt(self.settlement['_id'], showdown_type)
 
 
     def set_storage(self):
@@ -1540,6 +1626,13 @@ class Settlement(Models.UserAsset):
         self.log_event("%s set target monster to %s" % (request.User.login, new_quarry), event_type="set_quarry")
         self.save()
 
+        # the hunting party has to come out of the mdb, so if we're buffering
+        #   writes (i.e. in new()), wait until the survivors are in there
+        if self.buffering():
+            self.write_buffer.after_flush(live_activity.start_hunt, self.settlement)
+        else:
+            live_activity.start_hunt(self.settlement)
+
 
 
     def set_location_level(self):
@@ -1617,10 +1710,11 @@ class Settlement(Models.UserAsset):
         if exclude_types != []:
             A.filter("type", exclude_types)
 
-        # update available
+        # update available; only copy the ones we're keeping
+        records = A.get_records()
         for n in A.get_handles():
-            asset_dict = A.get_asset(n)
-            if self.is_compatible(asset_dict):
+            if self.is_compatible(records.get(n, None) or A.get_asset(n)):
+                asset_dict = A.get_asset(n)
                 if handles: # return a dict
                     available.update({asset_dict["handle"]: asset_dict})
                 else:       # return a list of dicts
@@ -1809,8 +1903,8 @@ class Settlement(Models.UserAsset):
 
         if return_type == "min":
             min_death_count = 0
-            for s in self.get_survivors(list):
-                if s.get("dead", False):
+            for s in self.survivors:
+                if s.is_dead():
                     min_death_count += 1
             return min_death_count
 
@@ -1925,10 +2019,11 @@ class Settlement(Models.UserAsset):
 
 
     def get_founder(self):
-        """ Helper method to rapidly get the mdb document of the settlement's
-        creator/founder. """
+        """ Helper method to rapidly get the settlement's creator/founder.
+        Returns a user_directory entry, i.e. a dict with '_id', 'login' and
+        'admin' keys (not the whole mdb document). """
 
-        return utils.mdb.users.find_one({"_id": self.settlement["created_by"]})
+        return user_directory.get(self.settlement["created_by"])
 
 
     def get_innovations(self, return_type=None, include_principles=False):
@@ -1952,6 +2047,50 @@ class Settlement(Models.UserAsset):
         return s_innovations
 
 
+    def get_innovation_graph(self):
+        """ Returns the innovation dependency graph for the settlement's
+        campaign and expansions. The graph is compiled once per campaign and
+        expansion combination and then cached at the module level, since it's
+        the same for every settlement that has the same campaign/expansions.
+
+        The graph is a dict with the following keys:
+
+            'compatible': every innovation that is compatible with the
+                settlement, keyed by handle (principles included).
+            'available': compatible innovations that are not principles,
+                i.e. the ones that can show up in the deck.
+            'consequences': maps available innovation handles to the set of
+                handles they unlock.
+            'available_if': a list of (innovation handle, asset handle,
+                settlement attribute) edges: the innovation is in the deck if
+                the asset is in the settlement attribute.
+        """
+
+        graph_key = (self.campaign.handle, tuple(sorted(self.get_expansions())))
+        if graph_key in innovation_graphs:
+            return innovation_graphs[graph_key]
+
+        graph = {'compatible': {}, 'available': {}, 'consequences': {}, 'available_if': []}
+
+        for i_handle in self.Innovations.get_handles():
+            i_dict = self.Innovations.get_asset(i_handle)
+            if not self.is_compatible(i_dict):
+                continue
+
+            graph['compatible'][i_handle] = i_dict
+            if i_dict.get('type', None) == 'principle':
+                continue
+
+            graph['available'][i_handle] = i_dict
+            if i_dict.get('consequences', None) is not None:
+                graph['consequences'][i_handle] = set(i_dict['consequences'])
+            for asset, collection in i_dict.get('available_if', []):
+                graph['available_if'].append((i_handle, asset, collection))
+
+        innovation_graphs[graph_key] = graph
+        return graph
+
+
     def get_innovation_deck(self, return_type=False):
         """ Uses the settlement's current innovations to create an Innovation
         Deck, which, since it's a pure game asset, is returned as a list of
@@ -1962,52 +2101,33 @@ class Settlement(Models.UserAsset):
         #   thing that the legacy app did in like, three different places to be
         #   the ultimately, single/central source of truth
         #
-        #   The general logic of this method is that we start with a huge list
-        #   of all possible options and then filter it down to a baseline.
+        #   The heavy lifting (i.e. figuring out which innovations are even
+        #   possible and how they relate to each other) is done once, by
+        #   get_innovation_graph(): all we do here is walk the graph from the
+        #   innovations the settlement has got.
         #
-        #   Once we've got that baseline, we check the individual innovations
-        #   we've got left to see if we keep them in the deck. 
-
-        time.sleep(1)   # hack city! makes it feel more like something is
-                        # happening; slows the users down
 
-        available = dict(self.get_available_assets(innovations)["innovations"])
+        graph = self.get_innovation_graph()
+        current = set(self.settlement["innovations"])
 
-        # remove principles and innovations from expansions we don't use
-        for a in available.keys():
-            if available[a].get("type", None) == "principle":
-                del available[a]
+        # consequences of the innovations we've already got
+        consequences = set()
+        for i_handle in current:
+            consequences.update(graph['consequences'].get(i_handle, []))
 
-        # remove ones we've already got and make a list of consequences
-        consequences = []
-        for i_handle in self.settlement["innovations"]:
-            if available[i_handle].get("consequences",None) is not None:
-                consequences.extend(available[i_handle]["consequences"])
-            if i_handle in available.keys():
-                del available[i_handle]
-        consequences = list(set(consequences))
-
-
-        # now, we use the baseline and the consequences list to build a deck
+        # now, we use the consequences to build a deck
         deck_dict = {}
-        for c in consequences:
-            if c not in self.settlement["innovations"]:
-                if c in available.keys():
-                    del available[c]
-                asset_dict = self.Innovations.get_asset(c)
-                if self.is_compatible(asset_dict):
-                    deck_dict[c] = asset_dict
-
+        for c in consequences - current:
+            if c in graph['compatible']:
+                deck_dict[c] = copy(graph['compatible'][c])
 
         # we've got a good list, but we still need to check available inno-
         # vations for some attribs that might force them into the list.
-        for i in available:
-            available_if = available[i].get("available_if",None)
-            if available_if is not None:
-                for tup in available_if:
-                    asset,collection = tup
-                    if asset in self.settlement[collection]:
-                        deck_dict[i] = self.Innovations.get_asset(i)
+        for i_handle, asset, collection in graph['available_if']:
+            if i_handle in current or i_handle in consequences:
+                continue
+            if asset in self.settlement.get(collection, []):
+                deck_dict[i_handle] = copy(graph['available'][i_handle])
 
         # finally, create a new list and use the deck dict to 
         deck_list = []
@@ -2119,70 +2239,110 @@ class Settlement(Models.UserAsset):
         return [n for n in notes]
 
 
-    def get_settlement_storage(self):
-        """ Returns a JSON-ish representation of settlement storage, meant to
-        facilitate front-end design.
+    def get_storage_catalog(self):
+        """ Returns the storage catalog for the settlement's campaign and
+        expansions: this is everything about storage that does NOT depend on
+        what's actually in the settlement's storage, so we compile it once per
+        campaign/expansions combination and cache it at the module level.
 
-        We're basically constructing a data structure/schema here, so it gets a
-        little messy.
-        """
+        The catalog is a dict with these keys:
 
-        gear_total = 0
-        resources_total = 0
+            'locations': an OrderedDict of compatible storage location dicts
+                (with expansion flair applied), keyed by handle.
+            'collections': maps location handles to a list of the compatible
+                gear/resource asset dicts that live in that location.
+            'items': every gear/resource asset dict, keyed by handle, for
+                looking up whatever turns up in settlement storage.
+        """
 
+        catalog_key = (self.campaign.handle, tuple(sorted(self.get_expansions())))
+        if catalog_key in storage_catalogs:
+            return storage_catalogs[catalog_key]
 
-        # get available storage locations into a dictionary of dicts
-        storage_repr = self.get_available_assets(storage)['storage']
+        catalog = {
+            'locations': self.get_available_assets(storage)['storage'],
+            'collections': {},
+            'items': {},
+        }
 
-        # now update the dictionaries in the big dict to have a new key
-        # called 'inventory' where we will park note handles
-        for k in storage_repr.keys():
-            storage_repr[k]['inventory'] = []
-            storage_repr[k]['digest'] = collections.OrderedDict()
-            storage_repr[k]['collection'] = []
-            S = storage.Storage(k)
-            for handle in S.get_collection():
-                if S.sub_type == 'gear':
-                    item_obj = gear.Gear(handle)
-                elif S.sub_type == 'resources':
-                    item_obj = resources.Resource(handle)
-                if self.is_compatible(item_obj):
-                    item_obj.quantity = self.settlement['storage'].count(item_obj.handle)
-                    if S.sub_type == 'gear':
-                        gear_total += item_obj.quantity
-                    elif S.sub_type == 'resources':
-                        resources_total += item_obj.quantity
-                    storage_repr[k]['collection'].append(item_obj.serialize(dict))
+        # resources first, so that gear wins if there's ever a handle collision
+        for sub_type, A in [('resources', self.Resources), ('gear', self.Gear)]:
+            for handle in A.get_handles():
+                item_dict = A.get_asset(handle)
+                if sub_type == 'resources':
+                    item_dict['consumable_keywords'] = ['fish','consumable','flower']
+                catalog['items'][handle] = item_dict
+
+        for k, loc_dict in catalog['locations'].iteritems():
+            catalog['collections'][k] = []
+            for item_dict in catalog['items'].values():
+                if item_dict.get('sub_type', None) == k and self.is_compatible(item_dict):
+                    catalog['collections'][k].append(item_dict)
+            catalog['collections'][k].sort(key=lambda i: i['handle'])
 
             # use expansion flair colors for gear locations from expansions
-            if storage_repr[k]['sub_type'] == 'gear' and 'expansion' in storage_repr[k].keys():
-                exp_dict = self.Expansions.get_asset(storage_repr[k]['expansion'])
-                storage_repr[k]['bgcolor'] = exp_dict['flair']['bgcolor']
-                storage_repr[k]['color'] = exp_dict['flair']['color']
-
-        # first thing we do is sort all handles from settlement storage into our
-        # 'inventory' lists
-        for item_handle in sorted(self.settlement['storage']):
-            item_obj = self.storage_handle_to_obj(item_handle)
-            item_type = item_obj.sub_type # this will be a key in storage_repr
-            if item_type in storage_repr.keys():
-                storage_repr[item_type]['inventory'].append(item_handle)
-                if item_handle in storage_repr[item_type]['digest'].keys():
-                   storage_repr[item_type]['digest'][item_handle]['count'] += 1
-                else:
-                    storage_repr[item_type]['digest'][item_handle] = {'count': 1, 'name': item_obj.name, 'handle': item_handle, 'desc': item_obj.desc, 'keywords': item_obj.keywords, 'rules': item_obj.rules}
+            if loc_dict['sub_type'] == 'gear' and 'expansion' in loc_dict.keys():
+                exp_dict = self.Expansions.get_asset(loc_dict['expansion'])
+                loc_dict['bgcolor'] = exp_dict['flair']['bgcolor']
+                loc_dict['color'] = exp_dict['flair']['color']
 
+        storage_catalogs[catalog_key] = catalog
+        return catalog
 
-        # now turn the digest dict into a list of dicts for easy iteration
-        for k in storage_repr.keys():
-            orig_digest = copy(storage_repr[k]['digest'])
-            storage_repr[k]['digest'] = []
-            for key, value in orig_digest.iteritems():
-                storage_repr[k]['digest'].append(value)
+
+    def get_settlement_storage(self):
+        """ Returns a JSON-ish representation of settlement storage, meant to
+        facilitate front-end design.
+
+        We're basically constructing a data structure/schema here, so it gets a
+        little messy.
+        """
+
+        catalog = self.get_storage_catalog()
+        quantities = collections.Counter(self.settlement['storage'])
+
+        # sanity check: bomb out on anything we can't look up (just like we
+        #   would if we tried to initialize it)
+        for item_handle in quantities.keys():
+            if item_handle not in catalog['items']:
+                self.Resources.get_asset(item_handle)
+
+        totals = collections.Counter()
+
+        # copy the locations out of the catalog, so we can add 'inventory' and
+        #   whatnot to them without touching the cached versions
+        storage_repr = collections.OrderedDict()
+        for k, loc_dict in catalog['locations'].iteritems():
+            loc_dict = copy(loc_dict)
+            loc_dict['inventory'] = []
+            loc_dict['digest'] = []
+            loc_dict['collection'] = []
+            for item_dict in catalog['collections'][k]:
+                item_dict = copy(item_dict)
+                item_dict['quantity'] = quantities.get(item_dict['handle'], 0)
+                totals[loc_dict['sub_type']] += item_dict['quantity']
+                loc_dict['collection'].append(item_dict)
+            storage_repr[k] = loc_dict
+
+        # now sort all handles from settlement storage into our 'inventory'
+        #   lists and create the digest for each location
+        for item_handle in sorted(quantities.keys()):
+            item_dict = catalog['items'][item_handle]
+            item_type = item_dict['sub_type'] # this will be a key in storage_repr
+            if item_type in storage_repr.keys():
+                storage_repr[item_type]['inventory'].extend([item_handle] * quantities[item_handle])
+                storage_repr[item_type]['digest'].append({
+                    'count': quantities[item_handle],
+                    'name': item_dict['name'],
+                    'handle': item_handle,
+                    'desc': item_dict['desc'],
+                    'keywords': item_dict['keywords'],
+                    'rules': item_dict['rules'],
+                })
 
         #finally, package up our main dicts for export as JSON
-        gear_dict = {'storage_type': 'gear', 'name': 'Gear', 'locations': [], 'total': gear_total}
-        reso_dict = {'storage_type': 'resources', 'name': 'Resource', 'locations': [], 'total': resources_total}
+        gear_dict = {'storage_type': 'gear', 'name': 'Gear', 'locations': [], 'total': totals['gear']}
+        reso_dict = {'storage_type': 'resources', 'name': 'Resource', 'locations': [], 'total': totals['resources']}
         for k in storage_repr.keys():
             if storage_repr[k]['sub_type'] == 'gear':
                 gear_dict['locations'].append(storage_repr[k])
@@ -2218,6 +2378,10 @@ class Settlement(Models.UserAsset):
                 views. It returns a specialized dictionary of survivor info that
                 is JSON-ish and meant to be used by front-end.
 
+        Filtering and grouping use self.survivor_index (see below) and each
+        survivor only gets serialized once, no matter how many times you call
+        this.
+
         The default output (i.e. no 'return_type') is a list of survivior
         dictionaries.
 
@@ -2231,6 +2395,9 @@ class Settlement(Models.UserAsset):
 
         if return_type == 'initialize':
             self.survivors = []
+            self.reset_survivor_index()
+            if not getattr(self, "load_survivors", True):
+                return True
             query = {"settlement": self.settlement["_id"]}
 
             # query mods
@@ -2245,22 +2412,22 @@ class Settlement(Models.UserAsset):
                 S = survivors.Survivor(_id=s["_id"], Settlement=self, normalize_on_init=False)
                 S.bug_fixes(force_save=True)
                 self.survivors.append(S)
+                self.survivor_index["by_id"][S._id] = S
+                self.update_survivor_index(S)
 #            self.logger.debug("%s Initialized %s survivors!" % (self, len(self.survivors)))
             return True
 
-        # now make a copy of self.survivors and work it to fulfill the request
-        output_list = copy(self.survivors)
-
-        # do filters
-        for s in output_list:
-            if exclude_dead and s.is_dead() and s in output_list:
-                output_list.remove(s)
-            if excluded != [] and s._id in excluded and s in output_list:
-                output_list.remove(s)
+        # now filter self.survivors to fulfill the request
+        output_list = self.survivors
+        if exclude_dead:
+            output_list = [s for s in output_list if s._id not in self.survivor_index["dead"]]
+        if excluded != []:
+            excluded = set(excluded)
+            output_list = [s for s in output_list if s._id not in excluded]
 
         # early returns
         if return_type == 'departing':
-            return [s.serialize(dict, False) for s in output_list if s.is_departing()]
+            return [self.serialize_survivor(s) for s in output_list if s._id in self.survivor_index["departing"]]
 
         #
         # late/fancy returns start here
@@ -2306,19 +2473,21 @@ class Settlement(Models.UserAsset):
                 },
             }
 
+            favorites = self.survivor_index["favorite"].get(request.User.login, set())
             for s in output_list:
-                if s.survivor.get('departing', None) == True:
-                    groups['departing']['survivors'].append(s.serialize(dict, False))
-                elif s.survivor.get('dead', None) == True:
-                    groups['the_dead']['survivors'].append(s.serialize(dict, False))
-                elif s.survivor.get('retired', None) == True:
-                    groups['retired']['survivors'].append(s.serialize(dict, False))
-                elif s.survivor.get('skip_next_hunt', None) == True:
-                    groups['skip_next']['survivors'].append(s.serialize(dict, False))
-                elif 'favorite' in s.survivor.keys() and request.User.login in s.survivor['favorite']:
-                    groups['favorite']['survivors'].append(s.serialize(dict, False))
+                if s._id in self.survivor_index["departing"]:
+                    group = 'departing'
+                elif s._id in self.survivor_index["dead"]:
+                    group = 'the_dead'
+                elif s._id in self.survivor_index["retired"]:
+                    group = 'retired'
+                elif s._id in self.survivor_index["skip_next_hunt"]:
+                    group = 'skip_next'
+                elif s._id in favorites:
+                    group = 'favorite'
                 else:
-                    groups['available']['survivors'].append(s.serialize(dict, False))
+                    group = 'available'
+                groups[group]['survivors'].append(self.serialize_survivor(s))
 
             # make it JSON-ish
             output = []
@@ -2328,44 +2497,100 @@ class Settlement(Models.UserAsset):
             return output
 
         # default return; assumes that we want a list of dictionaries
-        return [s.serialize(dict, False) for s in output_list]
+        return [self.serialize_survivor(s) for s in output_list]
 
 
-    def get_survival_actions(self, return_type=dict):
-        """ Returns a dictionary of survival actions available to the survivor
-        based on campaign type. Individual SAs are either 'available' or not,
-        depending on whether they're unlocked. """
+    #
+    #   survivor index: survivor objects by _id, plus sets of survivor _ids by
+    #   status, so that get_survivors() doesn't have to keep looking. Built by
+    #   get_survivors('initialize') and kept up to date by Survivor.save()
+    #
+    #   Serialized survivors also depend on the settlement (SAs, innovations,
+    #   etc.) and on each other (parents, partners), so any settlement or
+    #   survivor save throws out ALL of them (see invalidate_serialized())
+    #
 
+    def save(self, verbose=True):
+        """ Saves the settlement and throws out its serialized survivors. Also
+        points the request's SettlementContext for this settlement (if there
+        is one) at us, so that survivors don't keep reading a stale copy. """
 
-        # first, build the master dict based on the campaign def
-        sa_dict = {}
-        sa_handles = self.campaign.survival_actions
-        for handle in sa_handles:
-            sa_dict[handle] = self.SurvivalActions.get_asset(handle)
+        self.invalidate_serialized()
+        survivors.refresh_settlement_context(self)
+        return Models.UserAsset.save(self, verbose)
 
-        # set innovations to unavailable if their availablility is not defined
-        # already within their definition:
-        for k in sa_dict.keys():
-            if not "available" in sa_dict[k]:
-                sa_dict[k]["available"] = False
-                sa_dict[k]["title_tip"] = "'%s' has not been unlocked yet." % sa_dict[k]["name"]
 
-        # second, udpate the master list to say which are available
-        for k,v in self.get_innovations(dict).iteritems():
-            innovation_sa = v.get("survival_action", None)
-            if innovation_sa in sa_dict.keys():
-                sa_dict[innovation_sa]["available"] = True
-                sa_dict[innovation_sa]["title_tip"] = "Settlement innovation '%s' unlocks this ability." % v["name"]
+    def invalidate_serialized(self):
+        """ Drops every cached survivor serialization (see
+        serialize_survivor()). """
+
+        if getattr(self, "survivor_index", None) is not None:
+            self.survivor_index["serialized"] = {}
+
+    def reset_survivor_index(self):
+        """ Starts (or re-starts) an empty survivor index. """
+
+        self.survivor_index = {
+            "by_id": {},
+            "departing": set(),
+            "dead": set(),
+            "retired": set(),
+            "skip_next_hunt": set(),
+            "favorite": {},     # login -> set of _ids
+            "serialized": {},   # _id -> serialize(dict, False) output
+        }
 
-        # support a JSON return type:
-        if return_type=="JSON":
-            j_out = []
-            for sa_key in sa_dict.keys():
-                j_out.append(sa_dict[sa_key])
-            return sorted(j_out, key=lambda k: k['sort_order'])
 
-        # dict return
-        return sa_dict
+    def update_survivor_index(self, S):
+        """ (Re-)indexes one survivor object. Survivors that aren't part of
+        self.survivors are ignored. """
+
+        if S._id not in self.survivor_index["by_id"]:
+            return False
+
+        statuses = {
+            "departing": S.survivor.get("departing", None) == True,
+            "dead": S.is_dead(),
+            "retired": S.survivor.get("retired", None) == True,
+            "skip_next_hunt": S.survivor.get("skip_next_hunt", None) == True,
+        }
+        for status, value in statuses.iteritems():
+            if value:
+                self.survivor_index[status].add(S._id)
+            else:
+                self.survivor_index[status].discard(S._id)
+
+        for login, ids in self.survivor_index["favorite"].iteritems():
+            ids.discard(S._id)
+        for login in S.survivor.get("favorite", []):
+            self.survivor_index["favorite"].setdefault(login, set()).add(S._id)
+
+        self.invalidate_serialized()
+        return True
+
+
+    def serialize_survivor(self, S):
+        """ Returns S.serialize(dict, False), but only serializes each survivor
+        once (until it changes, anyway). """
+
+        serialized = self.survivor_index["serialized"].get(S._id, None)
+        if serialized is None:
+            serialized = S.serialize(dict, False)
+            self.survivor_index["serialized"][S._id] = serialized
+        return serialized
+
+
+    def get_survival_actions(self, return_type=dict):
+        """ Returns a dictionary of survival actions available to the survivor
+        based on campaign type. Individual SAs are either 'available' or not,
+        depending on whether they're unlocked. """
+
+        return build_survival_actions(
+            self.SurvivalActions,
+            self.campaign.survival_actions,
+            self.get_innovations(dict),
+            return_type,
+        )
 
 
     def get_survivor_attribute_milestones(self):
@@ -2393,7 +2618,7 @@ class Settlement(Models.UserAsset):
         """
 
         if return_type == bool:
-            for e_dict in self.list_assets("expansions"):
+            for e_dict in self.list_assets("expansions", records=True):
                 if not e_dict.get("enforce_survival_limit", True):
                     return False
             return True
@@ -2402,7 +2627,7 @@ class Settlement(Models.UserAsset):
             minimum = 0
 
             # process innovations
-            for i_dict in self.list_assets("innovations"):
+            for i_dict in self.list_assets("innovations", records=True):
                 minimum += i_dict.get("survival_limit", 0)
 
             # process principles (separately)
@@ -2422,7 +2647,7 @@ class Settlement(Models.UserAsset):
         survivor_weapon_masteries = set()
 
         for S in self.survivors:
-            for ai in S.list_assets("abilities_and_impairments"):
+            for ai in S.list_assets("abilities_and_impairments", records=True):
                 if ai["handle"] in self.WeaponMasteries.get_handles():
                     survivor_weapon_masteries.add(ai["handle"])
 
@@ -2662,10 +2887,10 @@ class Settlement(Models.UserAsset):
         for s in self.survivors:
             player_set.add(s.survivor["email"])
 
-        player_set = utils.mdb.users.find({"login": {"$in": list(player_set)}})
+        player_set = user_directory.get_many_by_login(player_set)
 
         if return_type == "count":
-            return player_set.count()
+            return len(player_set)
         elif return_type == "email":
             return [p["login"] for p in player_set]
 
@@ -2727,8 +2952,7 @@ class Settlement(Models.UserAsset):
 
         if not "admins" in self.settlement.keys():
             self.logger.info("Creating 'admins' key for %s" % (self))
-            creator = utils.mdb.users.find_one({"_id": self.settlement["created_by"]})
-            self.settlement["admins"] = [creator["login"]]
+            self.settlement["admins"] = [self.get_founder()["login"]]
             self.perform_save = True
 
         if not "custom_epithets" in self.settlement.keys():
@@ -3086,6 +3310,18 @@ class Settlement(Models.UserAsset):
         self.logger.debug("Migrated %s timeline to version 1.1" % (self))
 
 
+    def normalize_cross_document(self):
+        """ Settlement minimums come from the settlement's survivors, which can
+        change without the settlement document changing, so we enforce them
+        on every load, even if normalize() gets skipped. """
+
+        self.perform_save = False
+        self.enforce_minimums()
+        if self.perform_save:
+            self.save()
+        return self.perform_save
+
+
     def enforce_minimums(self):
         """ Enforces settlement minimums for Survival Limit, Death Count, etc.
         """
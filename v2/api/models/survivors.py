@@ -5,14 +5,37 @@ from bson.objectid import ObjectId
 from copy import copy
 from datetime import datetime
 from flask import request, Response
+import hashlib
 import json
 import random
 
+import counters
+import live_activity
 import Models
+import user_directory
 import utils
 
 from assets import survivor_sheet_options, survivors
-from models import abilities_and_impairments, cursed_items, disorders, endeavors, epithets, fighting_arts, names, saviors, survival_actions, survivor_special_attributes, the_constellations, weapon_proficiency
+from models import abilities_and_impairments, campaigns, cursed_items, disorders, endeavors, epithets, expansions, fighting_arts, innovations, names, saviors, survival_actions, survivor_special_attributes, the_constellations, weapon_proficiency
+
+
+# bump this whenever normalize() learns a new migration: documents stamped with
+#   the current version have been through all of them (see migrations.py)
+schema_version = 1.0
+
+# bump this whenever the derived state rules below (or compute_derived_state())
+#   change: survivors with cached derived state from an older version will
+#   recompute theirs
+derived_state_version = 1.0
+
+# derived state rules: if an A&I asset dict has the first key, the survivor's
+#   derived state gets the second key set to the third value
+derived_state_rules = [
+    ("cannot_be_nominated_for_intimacy",    "can_be_nominated_for_intimacy",    False),
+    ("cannot_gain_survival",                "can_gain_survival",                False),
+    ("cannot_spend_survival",               "cannot_spend_survival",            True),
+    ("cannot_use_fighting_arts",            "cannot_use_fighting_arts",         True),
+]
 
 
 class Assets(Models.AssetCollection):
@@ -49,6 +72,168 @@ class Assets(Models.AssetCollection):
 
 
 
+#
+#   slim settlement context for survivor requests
+#
+
+def get_settlement_context(settlement_id, write_buffer=None):
+    """ Returns a SettlementContext for 'settlement_id'. During a request,
+    contexts are cached on the request object, so a request that initializes
+    several survivors from the same settlement only loads it once.
+
+    Contexts with a 'write_buffer' never get cached (see __init__ below). """
+
+    if not request or write_buffer is not None:
+        return SettlementContext(settlement_id, write_buffer)
+
+    cache = getattr(request, "settlement_contexts", None)
+    if cache is None:
+        cache = {}
+        request.settlement_contexts = cache
+
+    if settlement_id not in cache:
+        cache[settlement_id] = SettlementContext(settlement_id)
+    return cache[settlement_id]
+
+
+def refresh_settlement_context(S):
+    """ Call this with a full settlements.Settlement object that has changed
+    (e.g. when it saves): if the request has a SettlementContext for that
+    settlement, the context starts using the Settlement. """
+
+    if not request:
+        return False
+
+    C = getattr(request, "settlement_contexts", {}).get(S._id, None)
+    if C is None or C.Settlement is S:
+        return False
+
+    C.set_settlement(S)
+    return True
+
+
+class SettlementContext(object):
+    """ A stand-in for settlements.Settlement for survivors that are
+    initialized without one (i.e. pretty much every /survivor request).
+
+    This loads the settlement document with a projection of just the fields
+    that survivor methods read, and answers the cheap questions (current LY,
+    Survival Limit, expansions, survival actions, etc.) from that. Anything
+    else (e.g. add_innovation(), update_population()) gets the full Settlement
+    object, which is initialized the first time it's needed.
+
+    Once there's a full Settlement, the context reads everything from its
+    document instead of the projection, so changes made by the Settlement
+    (in this request) show up here too. """
+
+    projection = [
+        "name", "campaign", "expansions", "innovations", "principles",
+        "lantern_year", "survival_limit", "population", "created_by",
+    ]
+
+    def __init__(self, settlement_id, write_buffer=None):
+        """ If the context has a 'write_buffer', the full Settlement gets it
+        too, and it gets loaded without its survivors (i.e. so that offline
+        callers like migrations.py don't write anything they don't mean to
+        and don't pay for survivors they don't need). """
+
+        self.Settlement = None
+        self.Campaign = None
+        self.write_buffer = write_buffer
+        self._id = settlement_id
+        self.settlement_id = settlement_id
+        self.collection = "settlements"
+        self.settlement = utils.mdb.settlements.find_one({"_id": settlement_id}, self.projection)
+        if self.settlement is None:
+            raise Models.AssetLoadError("Settlement _id '%s' could not be retrieved from mdb!" % settlement_id)
+
+    def __repr__(self):
+        return "settlements object '%s' [%s] (context)" % (self.settlement["name"], self._id)
+
+    def __getattr__(self, name):
+        """ Anything we don't do here gets done by the full Settlement. """
+
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.get_settlement(), name)
+
+    def get_settlement(self):
+        """ Initializes (once) and returns the full settlements.Settlement. """
+
+        if self.Settlement is None:
+            import settlements
+            self.Settlement = settlements.Settlement(
+                _id=self._id,
+                normalize_on_init=False,
+                write_buffer=self.write_buffer,
+                load_survivors=self.write_buffer is None,
+            )
+            self.set_settlement(self.Settlement)
+        return self.Settlement
+
+    def set_settlement(self, S):
+        """ Makes the context use 'S', a full settlements.Settlement, for
+        everything from here on out. """
+
+        self.Settlement = S
+        self.settlement = S.settlement
+        self.Campaign = None
+
+    def get_current_ly(self):
+        return int(self.settlement["lantern_year"])
+
+    def get_expansions(self, return_type=None):
+        if return_type is None:
+            return self.settlement.get('expansions', [])
+        return self.get_settlement().get_expansions(return_type)
+
+    def get_survival_limit(self, return_type=int):
+        if return_type == int:
+            return int(self.settlement["survival_limit"])
+        elif return_type == bool:
+            E = expansions.Assets()
+            for e in self.settlement.get("expansions", []):
+                e_dict = E.get_asset(e, backoff_to_name=True, raise_exception_if_not_found=False)
+                if e_dict is not None and not e_dict.get("enforce_survival_limit", True):
+                    return False
+            return True
+        return self.get_settlement().get_survival_limit(return_type)
+
+    def get_innovations(self, return_type=None, include_principles=False):
+        if self.Settlement is not None:
+            return self.Settlement.get_innovations(return_type, include_principles)
+
+        s_innovations = copy(self.settlement["innovations"])
+        if include_principles:
+            s_innovations.extend(self.settlement["principles"])
+        if return_type != dict:
+            return s_innovations
+
+        I = innovations.Assets()
+        output = {}
+        for i_handle in s_innovations:
+            i_dict = I.get_asset(i_handle, backoff_to_name=True, raise_exception_if_not_found=False)
+            if i_dict is not None:
+                output[i_handle] = i_dict
+        return output
+
+    def get_survival_actions(self, return_type=dict):
+        if self.Settlement is not None:
+            return self.Settlement.get_survival_actions(return_type)
+
+        import settlements
+        if self.Campaign is None:
+            c_dict = campaigns.Assets().get_asset(self.settlement["campaign"], backoff_to_name=True)
+            self.Campaign = campaigns.Campaign(c_dict["handle"])
+        return settlements.build_survival_actions(
+            survival_actions.Assets(),
+            self.Campaign.survival_actions,
+            self.get_innovations(dict),
+            return_type,
+        )
+
+
+
 class Survivor(Models.UserAsset):
     """ This is the base class for all expansions. Private methods exist for
     enabling and disabling expansions (within a campaign/settlement). """
@@ -61,6 +246,7 @@ class Survivor(Models.UserAsset):
     def __init__(self, *args, **kwargs):
         self.collection="survivors"
         self.object_version = 0.76
+        self.schema_version = schema_version
 
         # initialize AssetCollections for later
         self.Disorders = disorders.Assets()
@@ -92,15 +278,25 @@ class Survivor(Models.UserAsset):
         # Models.UserAsset class:
         Models.UserAsset.__init__(self,  *args, **kwargs)
 
-        # this makes the baby jesus cry
+        # this used to make the baby jesus cry: now we get a slim settlement
+        #   context that only loads the full Settlement if it has to
         if self.Settlement is None:
-            if request and request.collection != 'survivor':
-                self.logger.warn("%s Initializing Settlement object! THIS IS BAD FIX IT" % self)
-            import settlements
-            self.Settlement = settlements.Settlement(_id=self.survivor["settlement"], normalize_on_init=False)
+            self.Settlement = get_settlement_context(self.survivor["settlement"], self.write_buffer)
 
         if self.normalize_on_init:
-            self.normalize()
+            self.normalize_if_stale()
+
+
+    def save(self, verbose=True):
+        """ Saves the survivor and then updates its settlement's survivor index,
+        if the settlement has one (i.e. if it's a full Settlement object). """
+
+        Models.UserAsset.save(self, verbose)
+
+        # check the class, so that a SettlementContext doesn't go and load the
+        #   full Settlement just to tell us it hasn't got an index
+        if getattr(self.Settlement.__class__, "update_survivor_index", None) is not None:
+            self.Settlement.update_survivor_index(self)
 
 
     def new(self):
@@ -132,10 +328,14 @@ class Survivor(Models.UserAsset):
         #
         #   Can't create a survivor without initializing a settlement! do
         #   that first, an fail bigly if you cannot
+
+        #   (unless we're being created BY a settlement, in which case it's
+        #   already in memory and we use that)
         #
 
-        import settlements  # baby jesus, still crying
-        self.Settlement = settlements.Settlement(_id=attribs["settlement"])
+        if self.Settlement is None or self.Settlement.settlement["_id"] != ObjectId(attribs["settlement"]):
+            import settlements  # baby jesus, still crying
+            self.Settlement = settlements.Settlement(_id=attribs["settlement"])
         self.settlement_id = self.Settlement.settlement["_id"]
 
 
@@ -247,7 +447,14 @@ class Survivor(Models.UserAsset):
         # 1.f now save, get an OID so we can start logging and
         #   start calling object/class methods
 
-        self._id = utils.mdb.survivors.insert(self.survivor)
+        if self.buffering():
+            self._id = self.write_buffer.insert("survivors", self.survivor)
+            self.write_buffer.increment("total_survivors")
+            self.write_buffer.increment("live_survivors")
+        else:
+            self._id = utils.mdb.survivors.insert(self.survivor)
+            counters.increment("total_survivors")
+            counters.increment("live_survivors")
         self.load()
         self.log_event("%s created new survivor %s" % (request.User.login, self.pretty_name()))
 
@@ -362,9 +569,12 @@ class Survivor(Models.UserAsset):
         return self._id
 
 
-    def normalize(self):
+    def normalize(self, save=True):
         """ In which we force the survivor's mdb document to adhere to the biz
-        logic of the game and our own data model. """
+        logic of the game and our own data model.
+
+        Set 'save' to False to leave saving to the caller (e.g. migrations.py),
+        which can check self.perform_save to see whether anything changed. """
 
         self.perform_save = False
 
@@ -423,7 +633,12 @@ class Survivor(Models.UserAsset):
         # enforce minimum attributes for certain attribs
         self.min_attributes()
 
-        if self.perform_save:
+        # stamp the schema version and content hash
+        self.normalized = True
+        if self.stamp_normalization():
+            self.perform_save = True
+
+        if self.perform_save and save:
             self.logger.info("%s survivor modified during normalization! Saving changes..." % self)
             self.save()
 
@@ -441,16 +656,14 @@ class Survivor(Models.UserAsset):
         if include_meta:
             output = self.get_serialize_meta()
 
-        # build the sheet: don't forget to add cursed items to it
-        output.update({"sheet": self.survivor})
-        output["sheet"].update({"effective_sex": self.get_sex()})
-        output["sheet"].update({"can_be_nominated_for_intimacy": self.can_be_nominated_for_intimacy()})
-        output["sheet"].update({"can_gain_survival": self.can_gain_survival()})
-        output["sheet"].update({"cannot_spend_survival": self.cannot_spend_survival()})
-        output["sheet"].update({"cannot_use_fighting_arts": self.cannot_use_fighting_arts()})
-        output["sheet"].update({"skip_next_hunt": self.skip_next_hunt()})
-        output["sheet"].update({"founder": self.is_founder()})
-        output["sheet"].update({"savior": self.is_savior()})
+        # build the sheet: don't forget to add cursed items to it. The sheet is
+        #   a copy, so that the cached derived state can stay out of it
+        output.update({"sheet": copy(self.survivor)})
+        output["sheet"].pop("derived_state", None)
+        derived_state = self.get_derived_state()    # in memory only: don't save here!
+        output["sheet"].update({"effective_sex": derived_state["effective_sex"]})
+        for k in ["can_be_nominated_for_intimacy", "can_gain_survival", "cannot_spend_survival", "cannot_use_fighting_arts", "skip_next_hunt", "founder", "savior"]:
+            output["sheet"].update({k: derived_state[k]})
         output['sheet'].update({'parents': self.get_parents(dict)})
 
         # survivors whose campaigns use dragon traits get a top-level element
@@ -727,7 +940,9 @@ class Survivor(Models.UserAsset):
 
 
         # finally, save the survivor and return
+        self.invalidate_derived_state()
         if save:
+            self.get_derived_state()
             self.save()
 
 
@@ -761,7 +976,10 @@ class Survivor(Models.UserAsset):
 
 
         #   2.) initialize/import the AssetModule and an AssetCollection object
-        exec "AssetModule = %s" % asset_class
+        try:
+            AssetModule = Models.get_asset_module(asset_class)
+        except AttributeError:
+            raise utils.InvalidUsage("'%s' is not a known asset type!" % asset_class, status_code=400)
         A = AssetModule.Assets()
 
 
@@ -925,7 +1143,9 @@ class Survivor(Models.UserAsset):
         self.survivor[asset_class].remove(asset_dict["handle"])
         self.log_event("%s removed '%s' (%s) from %s" % (request.User.login, asset_dict["name"], asset_dict["type_pretty"], self.pretty_name()))
 
+        self.invalidate_derived_state()
         if save:
+            self.get_derived_state()
             self.save()
 
 
@@ -1234,8 +1454,13 @@ class Survivor(Models.UserAsset):
             del self.survivor[flag]
             self.log_event("%s removed '%s' from %s" % (request.User.login, flag_pretty, self.pretty_name()))
 
+        self.invalidate_derived_state()
+        self.get_derived_state()
         self.save()
 
+        if flag == 'departing':
+            live_activity.update_hunt(self.survivor['settlement'])
+
 
     #
     #   special game controls
@@ -1249,12 +1474,18 @@ class Survivor(Models.UserAsset):
         dead = self.params["dead"]
 
         if dead is False:
+            if self.is_dead():
+                counters.increment("dead_survivors", -1)
+                counters.increment("live_survivors")
             for death_key in ["died_on","died_in","cause_of_death","dead"]:
                 if death_key in self.survivor.keys():
                     del self.survivor[death_key]
                     self.logger.debug("%s Removed '%s' from %s" % (request.User, death_key, self))
             self.log_event("%s has resurrected %s!" % (request.User.login, self.pretty_name()))
         else:
+            if not self.is_dead():
+                counters.increment("live_survivors", -1)
+                counters.increment("dead_survivors")
             self.survivor["dead"] = True
             self.survivor["died_on"] = datetime.now()
 
@@ -1574,7 +1805,7 @@ class Survivor(Models.UserAsset):
             msg = "'%s Survivor email '%s' does not look like an email address! Ignoring..." % (self, new_email)
             self.logger.warn(msg)
             return Response(response=msg, status=200)
-        elif utils.mdb.users.find_one({'login': new_email}) is None:
+        elif user_directory.get_by_login(new_email) is None:
             msg = "The email address '%s' is not associated with any known user." % new_email
             self.logger.error(msg)
             return Response(response=msg, status=422)
@@ -1806,6 +2037,9 @@ class Survivor(Models.UserAsset):
 
         self.save()
 
+        if flag == 'departing':
+            live_activity.update_hunt(self.survivor['settlement'])
+
 
     def set_survival(self, value=0):
         """ Sets survivor["survival"] to 'value'. Respects settlement rules
@@ -1931,7 +2165,7 @@ class Survivor(Models.UserAsset):
 
 
         e_handles = set()
-        for a_dict in self.list_assets('abilities_and_impairments'):
+        for a_dict in self.list_assets('abilities_and_impairments', records=True):
             for e_handle in a_dict.get('endeavors', []):
                 if check_availability(e_handle):
                     e_handles.add(e_handle)
@@ -2151,15 +2385,15 @@ class Survivor(Models.UserAsset):
 
         if return_type == dict:
             output = {'mother': None, 'father': None}
-            for p_oid in parents:
-                p = utils.mdb.survivors.find_one({'_id': p_oid})
-                if p is not None:
-                    if p["sex"] == 'M':
-                        output['father'] = p
-                    elif p['sex'] == 'F':
-                        output['mother'] = p
-                    else:
-                        raise
+            if parents == []:
+                return output
+            for p in utils.mdb.survivors.find({'_id': {'$in': parents}}):
+                if p["sex"] == 'M':
+                    output['father'] = p
+                elif p['sex'] == 'F':
+                    output['mother'] = p
+                else:
+                    raise
             return output
 
         return parents
@@ -2171,19 +2405,7 @@ class Survivor(Models.UserAsset):
         survivor's sheet on their sex and then apply any curses, etc. to get
         our answer. """
 
-        sex = self.survivor["sex"]
-
-        def invert_sex(s):
-            if s == "M":
-                return "F"
-            elif s == "F":
-                return "M"
-
-        for ai_dict in self.list_assets("abilities_and_impairments"):
-            if ai_dict.get("reverse_sex", False):
-                sex = invert_sex(sex)
-
-        return sex
+        return self.get_derived_state()["effective_sex"]
 
 
     def get_survival_actions(self, return_type=dict):
@@ -2191,61 +2413,26 @@ class Survivor(Models.UserAsset):
         impairments, etc. Use 'return_type' = 'JSON' to get a list of dicts
         back, rather than a single dict.
 
-        Important! There's a ton of business logic here, given that there's a
-        lot of interplay among game assets, so read this carefully and all the
-        way through before making changes!
+        Important! The business logic for which A&Is/FAs enable and disable
+        which SAs lives in compute_derived_state(), so read that carefully and
+        all the way through before making changes!
         """
 
-        # helper called later
-        def update_available(sa_key_list, available=False, title_tip=None):
-            """ Inline helper func to update the list of available_actions while
-            iterating over survivor attributes. """
-
-            for sa_key in sa_key_list:
-                if not available:
-                    if sa_key in available_actions.keys():
-                        available_actions[sa_key]["available"] = False
-                        available_actions[sa_key]["title_tip"] = title_tip
-                elif available:
-                    sa = SA.get_asset(sa_key)
-                    sa["available"] = True
-                    sa["title_tip"] = title_tip
-                    available_actions[sa_key] = sa
-
-
-        #
-        #   action starts here. initialize and set defaults first:
-        #
-
-        AI = abilities_and_impairments.Assets()
         SA = survival_actions.Assets()
-
         available_actions = self.Settlement.get_survival_actions()
 
-
-        # check A&Is and FAs/SFAs   # disorders coming soon! TKTK
-        attrib_keys = ['abilities_and_impairments', 'fighting_arts']
-
-        for ak in attrib_keys:
-            for a_dict in self.list_assets(ak):             # iterate assets
-                if "survival_actions" in a_dict.keys():     # check for SA key
-
-                    # handle 'enable' keys; special logic re: can't use FAs
-                    if ak == 'fighting_arts' and self.cannot_use_fighting_arts():
-                        pass
-                    else:
-                        update_available(
-                            a_dict["survival_actions"].get("enable", []),
-                            available = True,
-                            title_tip = "Available due to '%s'" % a_dict["name"],
-                        )
-
-                    # handle 'disable' keys
-                    update_available(
-                        a_dict["survival_actions"].get("disable", []),
-                        available = False,
-                        title_tip = "Impairment '%s' prevents %s from using this ability." % (a_dict["name"], self.survivor["name"])
-                    )
+        # the survivor's A&Is and FAs/SFAs enable and disable SAs (see
+        #   compute_derived_state() for the biz logic); apply them in order
+        for sa_key, available, title_tip in self.get_derived_state()["survival_actions"]:
+            if not available:
+                if sa_key in available_actions.keys():
+                    available_actions[sa_key]["available"] = False
+                    available_actions[sa_key]["title_tip"] = title_tip
+            else:
+                sa = SA.get_asset(sa_key)
+                sa["available"] = True
+                sa["title_tip"] = title_tip
+                available_actions[sa_key] = sa
 
 
         # support JSON return
@@ -2268,54 +2455,28 @@ class Survivor(Models.UserAsset):
         """ Returns a bool representing whether the survivor can do the
         mommmy-daddy dance. """
 
-
-        for ai_dict in self.list_assets("abilities_and_impairments"):
-            if ai_dict.get("cannot_be_nominated_for_intimacy", False):
-                return False
-
-        if self.is_dead():
-            return False
-
-        return True
+        return self.get_derived_state()["can_be_nominated_for_intimacy"]
 
 
     def can_gain_survival(self):
         """ Returns a bool representing whether or not the survivor can GAIN
         survival. This is not whether they can SPEND survival. """
 
-        for ai_dict in self.list_assets("abilities_and_impairments"):
-            if ai_dict.get("cannot_gain_survival", False):
-                return False
-
-        return True
+        return self.get_derived_state()["can_gain_survival"]
 
 
     def cannot_spend_survival(self):
         """ Returns a bool representing whether or not the survivor can SPEND
         survival. This is not whether they can GAIN survival. """
 
-        if self.survivor.get("cannot_spend_survival", None) is True:
-            return True
-
-        for ai_dict in self.list_assets("abilities_and_impairments"):
-            if ai_dict.get("cannot_spend_survival", False):
-                return True
-
-        return False
+        return self.get_derived_state()["cannot_spend_survival"]
 
 
     def cannot_use_fighting_arts(self):
         """Returns a bool representing whether or not the survivor can use
         Fighting Arts. """
 
-        if self.survivor.get("cannot_use_fighting_arts", None) is True:
-            return True
-
-        for ai_dict in self.list_assets("abilities_and_impairments"):
-            if ai_dict.get("cannot_use_fighting_arts", False):
-                return True
-
-        return False
+        return self.get_derived_state()["cannot_use_fighting_arts"]
 
 
     def is_dead(self):
@@ -2379,6 +2540,112 @@ class Survivor(Models.UserAsset):
 
 
 
+    #
+    #   derived state: flags, effective sex, SAs, etc. that come from the
+    #   survivor's assets and get cached on the survivor's mdb document
+    #
+
+    def get_derived_state_inputs(self):
+        """ Returns a dict of everything that compute_derived_state() looks at.
+        If this doesn't change, the derived state doesn't change. """
+
+        return {
+            "version": derived_state_version,
+            "campaign": self.Settlement.settlement.get("campaign", None),
+            "name": self.survivor["name"],
+            "sex": self.survivor["sex"],
+            "born_in_ly": self.survivor["born_in_ly"],
+            "dead": self.is_dead(),
+            "savior": self.survivor.get("savior", False),
+            "abilities_and_impairments": sorted(self.survivor.get("abilities_and_impairments", [])),
+            "fighting_arts": sorted(self.survivor.get("fighting_arts", [])),
+            "flags": dict([(f, self.survivor.get(f, None)) for f in ["cannot_spend_survival", "cannot_use_fighting_arts", "skip_next_hunt"]]),
+        }
+
+
+    def get_derived_state_hash(self):
+        """ Returns a sha1 of get_derived_state_inputs(). """
+
+        return hashlib.sha1(json.dumps(self.get_derived_state_inputs(), sort_keys=True, default=json_util.default)).hexdigest()
+
+
+    def compute_derived_state(self):
+        """ Runs the survivor's assets through the derived state rules (see the
+        top of this module) and returns a dict of derived state. This is the
+        expensive part, i.e. it walks the survivor's assets, so don't call it directly:
+        use get_derived_state() instead.
+
+        The 'survival_actions' key is a list of [sa_handle, available, tip]
+        lists that get_survival_actions() applies, in order, to the
+        settlement's SAs. """
+
+        state = {
+            "effective_sex": self.survivor["sex"],
+            "can_be_nominated_for_intimacy": not self.is_dead(),
+            "can_gain_survival": True,
+            "cannot_spend_survival": self.survivor.get("cannot_spend_survival", None) is True,
+            "cannot_use_fighting_arts": self.survivor.get("cannot_use_fighting_arts", None) is True,
+            "skip_next_hunt": self.survivor.get("skip_next_hunt", None) is True,
+            "founder": self.is_founder(),
+            "savior": self.is_savior(),
+            "survival_actions": [],
+        }
+
+        # A&Is first: flags and curses
+        ai_dicts = self.list_assets("abilities_and_impairments", records=True)
+        for ai_dict in ai_dicts:
+            if ai_dict.get("reverse_sex", False):
+                state["effective_sex"] = {"M": "F", "F": "M"}.get(state["effective_sex"], None)
+            for asset_key, state_key, value in derived_state_rules:
+                if ai_dict.get(asset_key, False):
+                    state[state_key] = value
+
+        # now SAs: A&Is and FAs/SFAs can enable and disable them; FAs can't
+        #   enable anything if the survivor can't use FAs
+        for ak, a_dicts in [("abilities_and_impairments", ai_dicts), ("fighting_arts", self.list_assets("fighting_arts", records=True))]:
+            for a_dict in a_dicts:
+                if "survival_actions" not in a_dict.keys():
+                    continue
+
+                if not (ak == "fighting_arts" and state["cannot_use_fighting_arts"]):
+                    for sa_key in a_dict["survival_actions"].get("enable", []):
+                        state["survival_actions"].append([sa_key, True, "Available due to '%s'" % a_dict["name"]])
+
+                for sa_key in a_dict["survival_actions"].get("disable", []):
+                    tip = "Impairment '%s' prevents %s from using this ability." % (a_dict["name"], self.survivor["name"])
+                    state["survival_actions"].append([sa_key, False, tip])
+
+        return state
+
+
+    def get_derived_state(self):
+        """ Returns the survivor's derived state dict, recomputing it (and
+        caching it on self.survivor) only if its inputs have changed since the
+        last time it was computed.
+
+        This never saves: the methods that change the inputs (add_game_asset(),
+        rm_game_asset(), toggle_status_flag(), etc.) call this right before
+        they save, which is what gets the cached copy into the mdb. """
+
+        inputs_hash = self.get_derived_state_hash()
+        cached = self.survivor.get("derived_state", None)
+        if cached is not None and cached.get("inputs_hash", None) == inputs_hash:
+            return cached
+
+        state = self.compute_derived_state()
+        state["inputs_hash"] = inputs_hash
+        self.survivor["derived_state"] = state
+        return state
+
+
+    def invalidate_derived_state(self):
+        """ Drops the survivor's cached derived state, e.g. because one of its
+        assets changed. """
+
+        self.survivor.pop("derived_state", None)
+
+
+
     #
     #   conversion and normalization methods
     #
@@ -5,17 +5,19 @@ from bson.objectid import ObjectId
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from flask import Response, request
-from hashlib import md5
+from hashlib import md5, sha1
 import json
 import jwt
 import os
 import random
 import string
+import time
 from werkzeug.security import safe_str_cmp
 
 import Models
 from settlements import Settlement
 import settings
+import user_directory
 import utils
 
 
@@ -64,6 +66,9 @@ def refresh_authorization(expired_token):
     user changed his password.
     """
 
+    if is_revoked(expired_token):
+        return None
+
     decoded = jwt.decode(expired_token, secret_key, verify=False)
     user = dict(json.loads(decoded["identity"]))
     login = user["login"]
@@ -154,7 +159,13 @@ def jwt_identity_handler(payload):
 def token_to_object(request, strict=True):
     """ Processes the "Authorization" param in the header and returns an http
     response OR a user object. Requires the application's initialized JWT to
-    work. """
+    work.
+
+    Heads up: cached identities (see the identity cache, below) are served
+    without checking mdb.revoked_tokens, so logging out only takes effect
+    right away in the worker that handled the logout. Every other worker
+    keeps accepting the token until its cache entry expires, i.e. for up to
+    settings.api.identity_cache_ttl seconds. """
     # khoa's back door - chop this whole block when he gets CORS sorted out
     if request.method == "POST" and request.json.get('user_id', None) is not None:
         logger.warn("'user_id' key in POST body; attempting Khoa-style token-less auth...")
@@ -181,18 +192,210 @@ def token_to_object(request, strict=True):
         logger.error(msg)
         raise utils.InvalidUsage(msg, status_code=401)
 
-    # now, try to decode the token and get a dict
+    # check the identity cache before we decode anything: it only ever has
+    #   tokens that passed verification in it, so it's good for strict and
+    #   non-strict requests alike
+    identity = get_cached_identity(auth_token)
+    if identity is not None:
+        return Principal(identity)
+
+    if is_revoked(auth_token):
+        msg = "This token has been revoked (i.e. logged out)!"
+        logger.error(msg)
+        raise utils.InvalidUsage(msg, status_code=401)
+
+    # now, try to decode the token and get a dict; non-strict requests still
+    #   try to verify first, so that verified tokens can be cached
     try:
-        decoded = jwt.decode(auth_token, secret_key, verify=strict)
+        try:
+            decoded = jwt.decode(auth_token, secret_key, verify=True)
+            verified = True
+        except jwt.DecodeError:
+            raise
+        except Exception:
+            if strict:
+                raise
+            decoded = jwt.decode(auth_token, secret_key, verify=False)
+            verified = False
         user_dict = dict(json.loads(decoded["identity"]))
-        return User(_id=user_dict["_id"]["$oid"])
+        user_oid = ObjectId(user_dict["_id"]["$oid"])
     except jwt.DecodeError:
         logger.error("Incorrectly formatted token!")
         logger.error("Token contents: |%s|" % auth_token)
+        raise utils.InvalidUsage("Incoming JWT could not be processed!", status_code=422)
     except Exception as e:
         logger.exception(e)
+        raise utils.InvalidUsage("Incoming JWT could not be processed!", status_code=422)
+
+    # make sure the user still exists, but only pull what the principal needs
+    #   (plus the password hash: tokens issued before the user's last password
+    #   change are no good)
+    identity = utils.mdb.users.find_one({"_id": user_oid}, {"login": 1, "admin": 1, "password": 1})
+    if identity is None:
+        msg = "The OID '%s' does not belong to any known user!" % user_oid
+        logger.error(msg)
+        raise utils.InvalidUsage(msg, status_code=401)
+    if identity.pop("password", None) != user_dict.get("password", None):
+        msg = "%s token was issued before the user's last password change!" % identity["login"]
+        logger.error(msg)
+        raise utils.InvalidUsage(msg, status_code=401)
+
+    if verified:
+        cache_identity(auth_token, identity, decoded.get("exp", None))
+    return Principal(identity)
+
+
+
+#
+#   identity cache: maps tokens to the bare minimum we need to know about a user
+#       so that we don't have to load a whole User object on every request.
+#       Only verified tokens get cached and no entry outlives its token.
+#
+#   Logging out revokes a token: revoked tokens go into mdb.revoked_tokens
+#       (with a TTL index, so they go away once the token would've expired
+#       anyway) and get checked on every cache miss. Cache hits DO NOT get
+#       checked, so other API workers keep serving a revoked token from their
+#       caches for up to settings.api.identity_cache_ttl seconds.
+#
+
+identity_cache = {}
+identity_cache_ttl = settings.get("api", "identity_cache_ttl")
+identity_cache_max = settings.get("api", "identity_cache_max")
+
+indexes = {"ensured": False}
+
+
+def ensure_indexes():
+    """ Creates the TTL index on mdb.revoked_tokens if we haven't already done
+    it in this process. """
+
+    if indexes["ensured"]:
+        return True
+
+    utils.mdb.revoked_tokens.create_index("expires_on", expireAfterSeconds=0)
+    indexes["ensured"] = True
+    return True
+
+
+def get_cached_identity(token):
+    """ Returns the cached identity dict for 'token' or None if we haven't got
+    one (or if the one we had has expired). """
+
+    cached = identity_cache.get(token, None)
+    if cached is None:
+        return None
+
+    expires, identity = cached
+    if expires < time.time():
+        identity_cache.pop(token, None)
+        return None
+
+    return identity
+
+
+def cache_identity(token, identity, token_expires=None):
+    """ Adds an identity dict to the cache. If the cache is full, expired
+    entries are dropped first and then, if we're still full, the ones that are
+    closest to expiring get the boot.
+
+    Set 'token_expires' to the token's 'exp' claim (a unix timestamp) to keep
+    the entry from outliving the token. """
+
+    if len(identity_cache) >= identity_cache_max:
+        now = time.time()
+        for k, v in identity_cache.items():
+            if v[0] < now:
+                identity_cache.pop(k, None)
+
+        overflow = len(identity_cache) - identity_cache_max + 1
+        if overflow > 0:
+            by_age = sorted(identity_cache.items(), key=lambda i: i[1][0])
+            for k, v in by_age[:overflow]:
+                identity_cache.pop(k, None)
+
+    expires = time.time() + identity_cache_ttl
+    if token_expires is not None:
+        expires = min(expires, token_expires)
+    identity_cache[token] = (expires, identity)
+
+
+def revoke_token(token):
+    """ Revokes a token, i.e. on logout: drops it from the identity cache and
+    adds it to mdb.revoked_tokens until it would have expired (or for
+    settings.api.revoked_token_max_age days, whichever comes first).
+
+    The logout route doesn't require auth, so only tokens that we signed get
+    revoked: expired ones are fine, but forged ones get a 401. """
+
+    try:
+        decoded = jwt.decode(token, secret_key, verify=True, options={"verify_exp": False})
+    except jwt.InvalidTokenError as e:
+        logger.error("Refusing to revoke token: %s" % e)
+        return utils.http_401
+
+    identity_cache.pop(token, None)
+
+    max_expires_on = datetime.now() + timedelta(days=settings.get("api","revoked_token_max_age"))
+    expires_on = max_expires_on
+    try:
+        if time.time() < float(decoded["exp"]) < time.mktime(max_expires_on.timetuple()):
+            expires_on = datetime.fromtimestamp(float(decoded["exp"]))
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    ensure_indexes()
+    utils.mdb.revoked_tokens.save({"_id": sha1(token).hexdigest(), "expires_on": expires_on})
+    return utils.http_200
+
+
+def is_revoked(token):
+    """ Returns True if 'token' has been revoked (see revoke_token()). """
+
+    return utils.mdb.revoked_tokens.find_one({"_id": sha1(token).hexdigest()}, {"_id": 1}) is not None
+
+
+def invalidate_user(user_oid):
+    """ Drops every cached token that belongs to 'user_oid', e.g. when the user
+    changes their password. """
+
+    for k, v in identity_cache.items():
+        if v[1]["_id"] == user_oid:
+            identity_cache.pop(k, None)
+
+
+
+class Principal(object):
+    """ A lightweight stand-in for a User object: knows the user's _id, login
+    and whether they're an admin, which is all most requests ever ask for.
+
+    Anything else you ask it for causes the real User object to be loaded
+    (once per Principal) and the attribute is returned from that, so callers
+    can treat this just like a User. """
+
+    def __init__(self, identity):
+        self._User = None
+        self._id = identity["_id"]
+        self.id = str(self._id)
+        self.login = identity["login"]
+        self.admin = identity.get("admin", None) is not None
+
+    def __repr__(self):
+        return "[%s (%s)]" % (self.login, self._id)
+
+    def __getattr__(self, attr):
+        """ Only called when normal attribute lookup fails, i.e. when the
+        caller wants something that only the full User object has. """
+
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.get_user(), attr)
+
+    def get_user(self):
+        """ Loads (if necessary) and returns the full User object. """
 
-    raise utils.InvalidUsage("Incoming JWT could not be processed!", status_code=422)
+        if self._User is None:
+            self._User = User(_id=self._id)
+        return self._User
 
 
 
@@ -243,7 +446,7 @@ class User(Models.UserAsset):
         # make sure the new user doesn't already exist
 
         msg = "The email address '%s' is already in use by another user!" % username
-        if utils.mdb.users.find_one({'login': username}) is not None:
+        if user_directory.get_by_login(username) is not None:
             raise utils.InvalidUsage(msg)
 
 
@@ -388,6 +591,7 @@ class User(Models.UserAsset):
         self.user['password'] = md5(new_password).hexdigest()
         self.logger.warn("%s Changed password!" % self)
         self.save()
+        invalidate_user(self._id)
 
 
 
@@ -3,7 +3,7 @@
 # standard
 from bson import json_util
 from bson.objectid import ObjectId
-from copy import copy
+from bson.son import SON
 from datetime import datetime, timedelta
 import json
 import os
@@ -12,35 +12,115 @@ import sys
 
 # project
 import utils
-from models import users, settlements
+from models import users, campaigns, expansions
 
 logger = utils.get_logger(log_name="server")
 
-def get_settlement_data():
-    """ Returns JSON about recently updated settlements. Also serializes those
-    settlements and gets their event_log. """
+#
+#   the recent settlements feed is cached briefly, since the panel polls it
+#
 
-    recent_cutoff = datetime.now() - timedelta(hours=settings.get("application","recent_user_horizon"))
+settlement_feed_cache = {}
 
-    s_info = []
 
+def get_settlement_data(page=0, limit=None):
+    """ Returns JSON about recently updated settlements, most recently updated
+    first. Uses one aggregation to find each settlement's latest event and
+    returns a lightweight summary of each settlement (i.e. only the bits the
+    admin panel actually shows) rather than a full serialization.
+
+    Use 'page' and 'limit' to page through the feed. Results are cached for
+    a little while, per page/limit combination. """
+
+    page = int(page)
+    if limit is None:
+        limit = settings.get("application","admin_feed_limit")
+    limit = int(limit)
+
+    # check the cache first
+    cached = settlement_feed_cache.get((page, limit), None)
+    if cached is not None and cached[0] > datetime.now():
+        return cached[1]
+
+    recent_cutoff = datetime.now() - timedelta(hours=settings.get("application","recent_user_horizon"))
     ids = utils.mdb.settlements.find({'last_accessed': {'$gte': recent_cutoff}}).distinct('_id')
 
-    sorting_hat = {}
-    for s_id in ids:
-        last_updated = utils.mdb.settlement_events.find({'settlement_id': s_id}).limit(1).sort("created_on",-1)[0]['created_on']
-        sorting_hat[last_updated] = s_id
+    # one trip: latest event per settlement, sorted, paged and joined to a
+    #   summary projection of the settlement itself
+    results = utils.mdb.settlement_events.aggregate([
+        {"$match": {"settlement_id": {"$in": ids}}},
+        {"$group": {"_id": "$settlement_id", "last_updated": {"$max": "$created_on"}}},
+        {"$sort": SON([("last_updated", -1), ("_id", 1)])},
+        {"$skip": page * limit},
+        {"$limit": limit},
+        {"$lookup": {
+            "from": "settlements",
+            "localField": "_id",
+            "foreignField": "_id",
+            "as": "settlement",
+        }},
+        {"$unwind": "$settlement"},
+        {"$project": {
+            "last_updated": 1,
+            "name": "$settlement.name",
+            "campaign": "$settlement.campaign",
+            "expansions": "$settlement.expansions",
+            "lantern_year": "$settlement.lantern_year",
+            "population": "$settlement.population",
+            "death_count": "$settlement.death_count",
+            "created_on": "$settlement.created_on",
+            "created_by": "$settlement.created_by",
+        }},
+    ])
+    summaries = [r for r in results]
+    page_ids = [s["_id"] for s in summaries]
 
-    sorted_ids = []
-    for timestamp in sorted(sorting_hat.keys(), reverse=True):
-        sorted_ids.append(sorting_hat[timestamp])
+    # creators and players: one query each, rather than one per settlement
+    players = {}
+    for r in utils.mdb.survivors.aggregate([
+        {"$match": {"settlement": {"$in": page_ids}}},
+        {"$group": {"_id": "$settlement", "emails": {"$addToSet": "$email"}}},
+    ]):
+        players[r["_id"]] = r["emails"]
 
-    for s_id in sorted_ids:
-        S = settlements.Settlement(_id=s_id, normalize_on_init=False)
-        s_dict = copy(S.serialize('dashboard'))
-        s_info.append(s_dict)
+    user_ids = [s.get("created_by", None) for s in summaries]
+    player_emails = set()
+    for emails in players.values():
+        player_emails.update(emails)
+    registered = utils.mdb.users.find(
+        {"$or": [{"_id": {"$in": user_ids}}, {"login": {"$in": list(player_emails)}}]},
+        {"login": 1},
+    )
+    logins = {}
+    for u in registered:
+        logins[u["_id"]] = u["login"]
+    registered_logins = set(logins.values())
 
-    return "[" + ",".join(s_info) + "]"
+    C = campaigns.Assets()
+    E = expansions.Assets()
+
+    s_info = []
+    for s in summaries:
+        s["expansions"] = s.get("expansions", None) or []
+        s["campaign_pretty"] = C.get_asset(s["campaign"], backoff_to_name=True)["name"]
+        s["expansions_pretty"] = utils.list_to_pretty_string(
+            [E.get_asset(e, backoff_to_name=True)["name"] for e in s["expansions"]]
+        )
+        s_info.append({
+            "meta": {
+                "creator_email": logins.get(s.get("created_by", None), None),
+                "age": utils.get_time_elapsed_since(s["created_on"], units='age'),
+                "player_email_list": [e for e in players.get(s["_id"], []) if e in registered_logins],
+                "last_updated": s["last_updated"],
+            },
+            "sheet": s,
+        })
+
+    output = json.dumps(s_info, default=json_util.default)
+    cache_ttl = timedelta(seconds=settings.get("application","admin_feed_cache_ttl"))
+    settlement_feed_cache[(page, limit)] = (datetime.now() + cache_ttl, output)
+
+    return output
 
 
 def get_user_data():
@@ -120,24 +200,93 @@ def get_user_data():
     return json.dumps(d, default=json_util.default)
 
 
-def serialize_system_logs():
-    """ Returns JSON represent application/system log output. """
+#
+#   log tailing: read backwards from the end of the file in blocks, so that we
+#       never have to load a whole (possibly enormous) log just to show the
+#       admin the last few lines of it
+#
+
+log_tail_cache = {}
+
+
+def tail(file_name, lines, floor=0, block_size=4096):
+    """ Returns a tuple of the last 'lines' lines of 'file_name' (oldest
+    first) and the offset of the end of the file.
+
+    Blocks are read backwards from the end of the file until we've got enough
+    lines or until we hit 'floor', which is an offset we're not allowed to
+    read before (e.g. for 'since offset' polling). """
+
+    with open(file_name, 'rb') as fh:
+        fh.seek(0, os.SEEK_END)
+        end = fh.tell()
+        floor = max(0, min(floor, end))
+        pos = end
+        data = ''
+        while pos > floor and data.count('\n') <= lines:
+            read_size = min(block_size, pos - floor)
+            pos -= read_size
+            fh.seek(pos)
+            data = fh.read(read_size) + data
 
-    d = {}
+    log_lines = data.splitlines(True)
+
+    # if we stopped in the middle of a line, that partial line doesn't count
+    if pos > floor and len(log_lines) > lines:
+        log_lines = log_lines[1:]
+
+    return log_lines[-lines:], end
+
+
+def tail_log(file_name, lines, since=None):
+    """ Wraps tail() with a cache keyed on the file's inode and size: if the
+    file hasn't changed since the last time we looked at it, we don't read it
+    at all.
+
+    If 'since' is an offset (i.e. from a previous call), only lines written
+    after that offset are returned. If the file has been rotated or truncated
+    out from under that offset, we start over from the end. """
+
+    stat = os.stat(file_name)
+
+    if since is not None:
+        since = int(since)
+        if since > stat.st_size:
+            since = None
+        elif since == stat.st_size:
+            return [], since
+
+    if since is None:
+        cached = log_tail_cache.get(file_name, None)
+        if cached is not None and cached[0] == (stat.st_ino, stat.st_size, lines):
+            return cached[1], cached[2]
+
+    log_lines, end = tail(file_name, lines, floor=since or 0)
+
+    if since is None:
+        log_tail_cache[file_name] = ((stat.st_ino, stat.st_size, lines), log_lines, end)
+
+    return log_lines, end
+
+
+def serialize_system_logs(offsets={}):
+    """ Returns JSON represent application/system log output. Lines are newest
+    first and the 'offsets' key tells the caller where each log ended, which
+    they can send back to us (as 'offsets') to only get what's new. """
+
+    d = {"offsets": {}}
 
     log_root = settings.get("application","log_root_dir")
+    log_limit = settings.get("application","log_summary_length")
 
     for l in ["world","api","server","world_daemon","gunicorn"]:
         log_file_name = os.path.join(log_root, "%s.log" % l)
         if os.path.isfile(log_file_name):
-            fh = file(log_file_name, "r")
-            log_lines = fh.readlines()
-            log_limit = settings.get("application","log_summary_length")
-            d[l] = [line for line in reversed(log_lines[-log_limit:])]
+            log_lines, end = tail_log(log_file_name, log_limit, offsets.get(l, None))
+            d[l] = [line for line in reversed(log_lines)]
+            d["offsets"][l] = end
         else:
             d[l] = ["'%s' does not exist!" % log_file_name]
 
 
     return json.dumps(d, default=json_util.default)
-
-
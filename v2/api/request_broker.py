@@ -2,6 +2,7 @@
 
 from flask import request, Response
 
+import catalogs
 import panel
 import utils
 
@@ -56,9 +57,12 @@ def get_admin_data(resource=None):
         if resource == 'user_data':
             return panel.get_user_data()
         if resource == 'settlement_data':
-            return panel.get_settlement_data()
+            return panel.get_settlement_data(
+                page = request.args.get('page', 0),
+                limit = request.args.get('limit', None),
+            )
         elif resource == 'logs':
-            return panel.serialize_system_logs()
+            return panel.serialize_system_logs(offsets=request.args.to_dict())
     except Exception as e:
         logger.error("Unable to return '%s' admin data!" % resource)
         logger.error(e)
@@ -95,6 +99,11 @@ def get_game_asset(collection):
     if request.json is None:
         return utils.http_422
 
+    # most of these can be served straight out of the pre-rendered catalogs
+    blob = catalogs.get_blob(collection, request.json.get("handle", None), request.json.get("name", None))
+    if blob is not None:
+        return catalogs.blob_response(blob)
+
     try:
         if collection == "monster":
             M = monsters.Assets()
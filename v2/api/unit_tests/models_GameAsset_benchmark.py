@@ -0,0 +1,109 @@
+#!/usr/bin/python2.7
+
+#
+#   Micro-benchmark for GameAsset object construction and asset module
+#   dispatch, before and after we got rid of exec:
+#
+#       - attribute binding: the old exec-based initialize_asset() (see
+#           ExecBinder below) vs. GameAsset.initialize_asset()
+#       - dispatch: the old exec-based 'models.<attrib>' lookup that
+#           list_assets() and friends used to do (see exec_asset_module()
+#           below) vs. Models.get_asset_module()
+#
+#   ...and then times constructing a handful of gear, resource and monster
+#   objects, which is the number that actually matters. Run it from v2/api,
+#   i.e.
+#
+#       $ python unit_tests/models_GameAsset_benchmark.py
+#
+
+import unit_test
+
+logger = unit_test.set_env()
+
+from datetime import datetime
+import timeit
+
+import Models
+import models
+from models import abilities_and_impairments, disorders, epithets, expansions, fighting_arts, gear, innovations, locations, monsters, resources
+import utils
+
+iterations = 1000
+
+# UserAsset attribs that list_assets() dispatches on, and where they go
+dispatch_attribs = [
+    ("abilities_and_impairments", abilities_and_impairments),
+    ("fighting_arts", fighting_arts),
+    ("disorders", disorders),
+    ("epithets", epithets),
+    ("innovations", innovations),
+    ("principles", innovations),
+    ("locations", locations),
+    ("expansions", expansions),
+]
+
+
+class ExecBinder(Models.GameAsset):
+    """ BEFORE: the legacy initialize_asset(), for comparison. """
+
+    def initialize_asset(self, asset_dict):
+        for k, v in asset_dict.iteritems():
+            if type(v) == str:
+                exec """self.%s = '%s' """ % (k,v.replace('"','\\"').replace("'","\\'"))
+            elif type(v) == datetime:
+                exec """self.%s = '%s' """ % (k,v.strftime(utils.ymd))
+            else:
+                exec "self.%s = %s" % (k,v)
+
+
+def exec_asset_module(attrib):
+    """ BEFORE: the legacy list_assets() module lookup, for comparison. """
+
+    if attrib == "principles":
+        return models.innovations
+    namespace = {"models": models}
+    exec "M = models.%s" % attrib in namespace
+    return namespace["M"]
+
+
+def time_it(func):
+    """ Returns the average time, in microseconds, of one call to 'func'. """
+    return timeit.timeit(func, number=iterations) / iterations * 1000000
+
+
+def dump_comparison(label, before, after):
+    print("\t%-26s before: %8.2f    after: %8.2f    (%.1fx)" % (label, before, after, before / after))
+
+
+if __name__ == "__main__":
+
+    samples = [
+        (gear.Gear, gear.Assets(), "Gear"),
+        (resources.Resource, resources.Assets(), "Resource"),
+        (monsters.Monster, monsters.Assets(), "Monster"),
+    ]
+
+    print("\n\tAttribute binding, before (exec) and after (__dict__.update)")
+    print("\t(usec per object, %s iterations):\n" % iterations)
+    for model, A, label in samples:
+        handles = A.get_handles()[:10]
+        dicts = [A.get_asset(h) for h in handles]
+        before = time_it(lambda: [ExecBinder().initialize_asset(d) for d in dicts]) / len(dicts)
+        after = time_it(lambda: [Models.GameAsset().initialize_asset(d) for d in dicts]) / len(dicts)
+        dump_comparison(label, before, after)
+
+    print("\n\tAsset module dispatch, before (exec) and after (get_asset_module())")
+    print("\t(usec per lookup, %s iterations):\n" % iterations)
+    for attrib, module in dispatch_attribs:
+        assert exec_asset_module(attrib) is module
+        assert Models.get_asset_module(attrib) is module
+        before = time_it(lambda: exec_asset_module(attrib))
+        after = time_it(lambda: Models.get_asset_module(attrib))
+        dump_comparison(attrib, before, after)
+
+    print("\n\tObject construction, after (usec per object, %s iterations):\n" % iterations)
+    for model, A, label in samples:
+        handle = A.get_handles()[0]
+        print("\t%-26s %8.1f    (%s)" % (label, time_it(lambda: model(handle=handle)), handle))
+    print("")
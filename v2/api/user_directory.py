@@ -0,0 +1,147 @@
+#!/usr/bin/python2.7
+
+#
+#   The user directory: a small, per-process cache of the three things that
+#   the rest of the API keeps asking mdb.users for, i.e. a user's _id, login
+#   and whether they're an admin.
+#
+#   Settlements (and survivors) need this stuff every time they get
+#   serialized or normalized (creator email, founder login, player lists,
+#   etc.) and it almost never changes, so we keep it here for
+#   settings.api.user_directory_ttl seconds instead of going to the mdb for
+#   it every time.
+#
+#   Entries in the directory look like this:
+#
+#       {'_id': <user ObjectId>, 'login': 'someone@example.com', 'admin': False}
+#
+#   Only users that exist get cached: a miss always goes to the mdb, so a
+#   brand new user shows up right away. User saves call update(), so logins
+#   and admin flags don't go stale either.
+#
+
+import time
+
+import settings
+import utils
+
+ttl = settings.get("api", "user_directory_ttl")
+max_entries = settings.get("api", "user_directory_max")
+
+by_id = {}      # _id -> (expires, entry)
+by_login = {}   # login -> _id
+
+projection = {"login": 1, "admin": 1}
+
+
+def make_entry(user):
+    """ Trims a user dict (e.g. a doc from mdb.users) down to a directory
+    entry. """
+
+    return {
+        "_id": user["_id"],
+        "login": user["login"],
+        "admin": user.get("admin", None) is not None,
+    }
+
+
+def add(user):
+    """ Adds a user dict to the directory and returns its entry. If the
+    directory is full, expired entries are dropped first and then, if we're
+    still full, the ones that are closest to expiring get the boot. """
+
+    if len(by_id) >= max_entries:
+        now = time.time()
+        for k, v in by_id.items():
+            if v[0] < now:
+                invalidate(k)
+
+        overflow = len(by_id) - max_entries + 1
+        if overflow > 0:
+            by_age = sorted(by_id.items(), key=lambda i: i[1][0])
+            for k, v in by_age[:overflow]:
+                invalidate(k)
+
+    entry = make_entry(user)
+    invalidate(entry["_id"])
+    by_id[entry["_id"]] = (time.time() + ttl, entry)
+    by_login[entry["login"]] = entry["_id"]
+    return entry
+
+
+def invalidate(user_id):
+    """ Drops a user from the directory, e.g. because they changed. """
+
+    cached = by_id.pop(user_id, None)
+    if cached is not None and by_login.get(cached[1]["login"], None) == user_id:
+        by_login.pop(cached[1]["login"], None)
+
+
+def update(user):
+    """ Call this whenever a user gets saved. """
+
+    return add(user)
+
+
+def get_cached(user_id):
+    """ Returns the cached entry for 'user_id' or None if we haven't got one
+    (or if the one we had has expired). """
+
+    cached = by_id.get(user_id, None)
+    if cached is None:
+        return None
+
+    expires, entry = cached
+    if expires < time.time():
+        invalidate(user_id)
+        return None
+
+    return entry
+
+
+def get(user_id):
+    """ Returns the entry for 'user_id', going to the mdb if it's not cached.
+    Returns None if there's no such user. """
+
+    entry = get_cached(user_id)
+    if entry is not None:
+        return entry
+
+    user = utils.mdb.users.find_one({"_id": user_id}, projection)
+    if user is None:
+        return None
+    return add(user)
+
+
+def get_by_login(login):
+    """ Like get(), but for a login (i.e. an email address). """
+
+    entry = get_cached(by_login.get(login, None))
+    if entry is not None:
+        return entry
+
+    user = utils.mdb.users.find_one({"login": login}, projection)
+    if user is None:
+        return None
+    return add(user)
+
+
+def get_many_by_login(logins):
+    """ Returns a list of entries for a list of logins. Anything that isn't
+    cached gets looked up with one query; logins that don't belong to any
+    user are left out. """
+
+    output = []
+    missing = []
+    for login in set(logins):
+        entry = get_cached(by_login.get(login, None))
+        if entry is None:
+            missing.append(login)
+        else:
+            output.append(entry)
+
+    if missing != []:
+        for user in utils.mdb.users.find({"login": {"$in": missing}}, projection):
+            output.append(add(user))
+
+    return output
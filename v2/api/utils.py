@@ -377,10 +377,7 @@ class AssetDict(dict):
         self.meta_attribs = attribs
 
         for k, v in self.meta_attribs.iteritems():
-            if type(v) == str:
-                exec """self.%s = "%s" """ % (k,v)
-            else:
-                exec "self.%s = %s" % (k,v)
+            setattr(self, k, v)
 
         self.update(d)
         self.add_vars_to_dict()
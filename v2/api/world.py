@@ -13,26 +13,37 @@ from pwd import getpwuid, getpwnam
 # general imports
 from bson.son import SON
 from bson import json_util
+from bson.binary import Binary
 from bson.objectid import ObjectId
 import collections
+from copy import copy, deepcopy
+import cStringIO
 import daemon
 from datetime import datetime, timedelta
+import gzip
+import hashlib
+import heapq
 import json
 from lockfile.pidlockfile import PIDLockFile
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
+from pymongo import UpdateOne
+import random
 from retry import retry
 import shutil
+import signal
 import subprocess
 import stat
 import time
 
 # local imports
 from assets import world as world_assets
+import counters
+import live_activity
 from models import innovations as innovations_models
 from models import monsters as monster_models
 from models import expansions as expansions_models
 from models import settlements as settlements_models
-from models import survivors as survivors_models
 from models import campaigns as campaigns_models
 from models import epithets as epithets_models
 import utils
@@ -72,16 +83,208 @@ class World:
 
     def refresh_all_assets(self, force=False):
         """ Updates all assets. Set 'force' to True to ignore 'max_age' and
-        'asset_max_age'. A wrapper for self.refresh_asset(). """
+        'asset_max_age'.
+
+        Staleness for every asset comes from a single query. The stale ones are
+        then refreshed in 'waves' (see get_refresh_plan()): declarative stats
+        that share a collection get one $facet query per collection, the rest
+        are refreshed concurrently on a thread pool whose size is set by
+        settings.world.refresh_threads, and each wave is written back in one
+        bulk write before the next one starts. """
 
         self.logger.info("Refreshing stale warehouse assets...")
+        utils.mdb.world.create_index("handle", unique=True)
 
-        self.total_refreshed_assets = 0
+        stale_assets = self.get_stale_assets(force)
+        results = self.refresh_assets(stale_assets)
+
+        self.total_refreshed_assets = len([r for r in results if r[1] is None])
+        self.logger.info("Refreshed %s/%s assets (%s stale, %s failed)." % (
+            self.total_refreshed_assets,
+            len(self.assets.keys()),
+            len(stale_assets),
+            len(stale_assets) - self.total_refreshed_assets,
+        ))
+        if self.total_refreshed_assets > 0:
+            self.publish_snapshot()
+
+
+    def refresh_assets(self, stale_assets):
+        """ Refreshes a list of initialized asset dicts, wave by wave, and
+        writes them to the mdb. Returns a list of (asset_dict, error) tuples
+        (see refresh_asset_dict()). """
+
+        results = []
+        if stale_assets != []:
+            pool_size = min(len(stale_assets), settings.get("world","refresh_threads"))
+            pool = ThreadPool(pool_size)
+            try:
+                for wave in self.get_refresh_plan(stale_assets):
+                    wave_results = []
+                    for collection, asset_dicts in wave["facets"].iteritems():
+                        wave_results.extend(self.refresh_facet(collection, asset_dicts))
+                    if wave["methods"] != []:
+                        wave_results.extend(pool.map(self.refresh_asset_dict, wave["methods"]))
+                    self.update_mdb(wave_results)
+                    results.extend(wave_results)
+            finally:
+                pool.close()
+                pool.join()
+
+        return results
+
+
+    def get_stale_assets(self, force=False):
+        """ Returns a list of initialized asset dicts for every asset that
+        needs a refresh (or for all of them, if 'force' is True). Anything that
+        depends on a stale asset is stale too. """
+
+        # one trip to the mdb for the age of everything
+        created_on = {}
+        for mdb_asset in utils.mdb.world.find({}, {"handle": 1, "created_on": 1}):
+            created_on[mdb_asset["handle"]] = mdb_asset.get("created_on", None)
+
+        stale_assets = {}
         for asset_key in self.assets.keys():
-            self.refresh_asset(asset_key, force=force)
-            self.total_refreshed_assets += 1
+            asset_dict = self.initialize_asset_dict(asset_key)
+            if force or self.is_stale(asset_dict, created_on.get(asset_key, None)):
+                stale_assets[asset_key] = asset_dict
+
+        return self.add_dependents(stale_assets)
+
+
+    def add_dependents(self, stale_assets):
+        """ Takes a dict of stale asset dicts (keyed by handle) and adds an
+        initialized asset dict for anything that depends on one of them.
+        Returns a list of asset dicts. """
+
+        # keep going until there are no more dependents to add
+        added = True
+        while added:
+            added = False
+            for asset_key in self.assets.keys():
+                if asset_key in stale_assets:
+                    continue
+                if set(self.get_stat(asset_key)["depends_on"]) & set(stale_assets.keys()):
+                    stale_assets[asset_key] = self.initialize_asset_dict(asset_key)
+                    added = True
+
+        return stale_assets.values()
+
+
+    def get_refresh_plan(self, stale_assets):
+        """ Works out how to refresh a list of stale asset dicts. Returns a
+        list of 'waves', where each wave is a dict like this:
+
+            {
+                'facets': {'settlements': [asset_dict, asset_dict, ...], ...},
+                'methods': [asset_dict, asset_dict, ...],
+            }
+
+        Nothing in a wave depends on anything in that wave or a later one, and
+        cheap stats come before expensive ones within a wave. """
+
+        pending = dict([(a["handle"], a) for a in stale_assets])
+
+        waves = []
+        while pending != {}:
+            ready = []
+            for asset_key in pending.keys():
+                if not set(self.get_stat(asset_key)["depends_on"]) & set(pending.keys()):
+                    ready.append(asset_key)
+
+            if ready == []:
+                msg = "World stats have circular dependencies: %s" % sorted(pending.keys())
+                self.logger.error(msg)
+                raise Exception(msg)
+
+            wave = {"facets": {}, "methods": []}
+            for asset_key in sorted(ready, key=lambda h: (self.get_stat(h)["cost"] == "expensive", h)):
+                stat = self.get_stat(asset_key)
+                if stat["pipeline"] is not None:
+                    wave["facets"].setdefault(stat["collection"], []).append(pending[asset_key])
+                else:
+                    wave["methods"].append(pending[asset_key])
+                del pending[asset_key]
+            waves.append(wave)
+
+        return waves
+
+
+    def dry_run(self, force=False):
+        """ Prints what refresh_all_assets() would do right now, without
+        actually doing any of it. CLI admin functionality. """
+
+        stale_assets = self.get_stale_assets(force)
+        print("\n\t%s/%s assets are stale (off-peak: %s)\n" % (len(stale_assets), len(self.assets.keys()), self.is_off_peak()))
+        spacer = 45
+        for i, wave in enumerate(self.get_refresh_plan(stale_assets)):
+            print("\tWave %s:" % i)
+            for collection, asset_dicts in sorted(wave["facets"].iteritems()):
+                utils.cli_dump("$facet on '%s'" % collection, spacer, [a["handle"] for a in asset_dicts])
+            for asset_dict in wave["methods"]:
+                utils.cli_dump("World.%s()" % asset_dict["handle"], spacer, self.get_stat(asset_dict["handle"])["cost"])
+            print("")
+
+
+    def explain(self, asset_key):
+        """ Prints an asset's registry entry and, for declarative stats, the
+        mdb's explanation of its pipeline. CLI admin functionality. """
+
+        asset_dict = self.initialize_asset_dict(asset_key)
+        stat = self.get_stat(asset_key)
+
+        print("\n\t%s\n" % asset_key)
+        spacer = 20
+        for k in ["name", "max_age", "limit"]:
+            utils.cli_dump(k, spacer, asset_dict.get(k, None))
+        for k in ["collection", "since", "default", "depends_on", "cost"]:
+            utils.cli_dump(k, spacer, stat[k])
+
+        if stat["pipeline"] is None:
+            utils.cli_dump("method", spacer, "World.%s()" % asset_key)
+            print("\n%s\n" % getattr(self, asset_key).__doc__)
+            return None
+
+        pipeline = self.get_pipeline(asset_key)
+        utils.cli_dump("pipeline", spacer, pipeline)
+        explanation = utils.mdb.command("aggregate", stat["collection"], pipeline=pipeline, explain=True)
+        print("\n%s\n" % json.dumps(explanation, default=json_util.default, indent=2))
+
+
+    def publish_snapshot(self):
+        """ Renders the complete /world JSON (i.e. warehouse data plus daemon
+        status) once and saves it to mdb.world_snapshot, along with a gzipped
+        copy, an ETag and a version number, so that API workers can serve it
+        without doing any of the work themselves. """
 
-        self.logger.info("Refreshed %s/%s assets." % (self.total_refreshed_assets, len(self.assets.keys())))
+        D = WorldDaemon()
+        d = {"world_daemon": D.dump_status(dict)}
+        d.update(self.list(dict))
+        generated_on = datetime.now()
+        d["meta"]["object"]["snapshot_generated_on"] = generated_on
+
+        j = json.dumps(d, default=json_util.default)
+
+        gz_buffer = cStringIO.StringIO()
+        gz_file = gzip.GzipFile(fileobj=gz_buffer, mode="wb")
+        gz_file.write(j)
+        gz_file.close()
+
+        utils.mdb.world_snapshot.update(
+            {"_id": "world"},
+            {
+                "$set": {
+                    "generated_on": generated_on,
+                    "etag": hashlib.sha1(j).hexdigest(),
+                    "json": j,
+                    "gzip": Binary(gz_buffer.getvalue()),
+                },
+                "$inc": {"version": 1},
+            },
+            upsert=True,
+        )
+        self.logger.debug("Published /world snapshot (%s bytes)." % len(j))
 
 
     def refresh_asset(self, asset_key=None, force=False, dump=False):
@@ -93,39 +296,112 @@ class World:
 
         asset_dict = self.initialize_asset_dict(asset_key)
 
-        # now determine whether we want to refresh it
-        do_refresh = False
-        current_age = None
-
-        mdb_asset = utils.mdb.world.find_one({"handle": asset_key})
+        mdb_asset = utils.mdb.world.find_one({"handle": asset_key}, {"created_on": 1})
         if mdb_asset is None:
             self.logger.debug("Asset handle '%s' not found in mdb!" % asset_key)
-            do_refresh = True
+            current_created_on = None
         else:
-            current_age = datetime.now() - mdb_asset["created_on"]
-        if current_age is None:
-            do_refresh = True
-        elif current_age.seconds > asset_dict["max_age"]:
-            self.logger.debug("Asset '%s' has a current age of %s seconds (max age is %s seconds)." % (asset_key, current_age.seconds, asset_dict["max_age"]))
-            do_refresh = True
-        if force:
-            do_refresh = True
-
-        # now do the refresh, if necessary
-        if do_refresh:
-            self.logger.debug("Refreshing '%s' asset..." % asset_key)
-            try:
-                self.update_asset_dict(asset_dict)
-                self.update_mdb(asset_dict)
-                self.logger.debug("Updated '%s' asset in mdb." % asset_key)
-            except Exception as e:
-                self.logger.error("Exception caught while refreshing '%s' asset!" % asset_key)
-                self.logger.exception(e)
+            current_created_on = mdb_asset.get("created_on", None)
+
+        if force or self.is_stale(asset_dict, current_created_on):
+            self.update_mdb([self.refresh_asset_dict(asset_dict)])
 
         if dump:
             print(asset_dict)
 
 
+    def is_stale(self, asset_dict, created_on=None):
+        """ Returns a bool representing whether an asset created on 'created_on'
+        is older than the asset's 'max_age'. Assets that have never been
+        created are always stale. """
+
+        if created_on is None:
+            return True
+
+        max_age = self.get_max_age(asset_dict)
+        current_age = (datetime.now() - created_on).total_seconds()
+        if current_age > max_age:
+            self.logger.debug("Asset '%s' has a current age of %s seconds (max age is %s seconds)." % (asset_dict["handle"], int(current_age), max_age))
+            return True
+
+        return False
+
+
+    def get_max_age(self, asset_dict):
+        """ Returns the number of seconds an asset is allowed to get before it
+        is stale. Expensive stats are allowed to get older during peak
+        hours. """
+
+        max_age = asset_dict["max_age"]
+        if self.get_stat(asset_dict["handle"])["cost"] == "expensive" and not self.is_off_peak():
+            max_age = max_age * settings.get("world","peak_age_multiplier")
+        return max_age
+
+
+    def is_off_peak(self):
+        """ Returns a bool representing whether we're currently between
+        settings.world.off_peak_start and settings.world.off_peak_end (which are
+        hours of the day, and which are allowed to wrap around midnight). """
+
+        hour = datetime.now().hour
+        start = settings.get("world","off_peak_start")
+        end = settings.get("world","off_peak_end")
+
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+
+    def refresh_asset_dict(self, asset_dict):
+        """ Refreshes an initialized asset dict and times it. Never raises:
+        returns a tuple of the asset dict and the exception, if there was one,
+        (or None if there wasn't) so that one bad asset can't spoil a whole
+        batch of them. """
+
+        self.logger.debug("Refreshing '%s' asset..." % asset_dict["handle"])
+        start = time.time()
+        error = None
+
+        try:
+            self.update_asset_dict(asset_dict)
+        except Exception as e:
+            self.logger.error("Exception caught while refreshing '%s' asset!" % asset_dict["handle"])
+            self.logger.exception(e)
+            error = e
+
+        asset_dict["refresh_duration"] = round(time.time() - start, 3)
+        return asset_dict, error
+
+
+    def refresh_facet(self, collection, asset_dicts):
+        """ Refreshes a list of declarative asset dicts that share a
+        collection with one $facet query. Like refresh_asset_dict(), this never
+        raises: it returns a list of (asset_dict, error) tuples. If the query
+        fails, every asset in it gets the error. """
+
+        self.logger.debug("Refreshing %s asset(s) from '%s' in one $facet..." % (len(asset_dicts), collection))
+        start = time.time()
+        error = None
+
+        try:
+            facets = dict([(a["handle"], self.get_pipeline(a["handle"])) for a in asset_dicts])
+            facet_results = list(utils.mdb[collection].aggregate([{"$facet": facets}]))[0]
+            for asset_dict in asset_dicts:
+                value = self.get_pipeline_value(asset_dict["handle"], facet_results[asset_dict["handle"]])
+                self.set_asset_value(asset_dict, value)
+        except Exception as e:
+            self.logger.error("Exception caught while refreshing '%s' facet!" % collection)
+            self.logger.exception(e)
+            error = e
+
+        refresh_duration = round(time.time() - start, 3)
+        results = []
+        for asset_dict in asset_dicts:
+            asset_dict["refresh_duration"] = refresh_duration
+            results.append((asset_dict, error))
+        return results
+
+
     def initialize_asset_dict(self, asset_key):
         """ Turn an asset key (e.g. 'top_innovations', etc.) into a basic dict
         that is ready to be updated/processed. """
@@ -136,33 +412,97 @@ class World:
             self.logger.exception(msg)
             raise Exception(msg)
 
-        asset_dict = self.assets[asset_key]
+        asset_dict = copy(self.assets[asset_key])
         asset_dict["handle"] = asset_key
+        for k in world_assets.registry_keys:
+            asset_dict.pop(k, None)
 
-        # default the asset's 'max_age' attribute if it hasn't got one
-        if asset_dict.get("max_age", None) is None:
-            asset_dict["max_age"] = settings.get("world", "asset_max_age") * 60
+        # assets declare 'max_age' in minutes (and default to the
+        #   world.asset_max_age setting, also in minutes), but everything
+        #   downstream of here works in seconds
+        max_age = asset_dict.get("max_age", None)
+        if max_age is None:
+            max_age = settings.get("world", "asset_max_age")
+        asset_dict["max_age"] = max_age * 60
 
         return asset_dict
 
 
 
+    def get_stat(self, asset_key):
+        """ Returns the registry entry for an asset, i.e. the registry keys
+        from its dict in assets/world.py, with defaults for the ones it doesn't
+        declare. """
+
+        a_dict = self.assets[asset_key]
+        return {
+            "collection": a_dict.get("collection", None),
+            "pipeline": a_dict.get("pipeline", None),
+            "since": a_dict.get("since", None),
+            "default": a_dict.get("default", None),
+            "depends_on": a_dict.get("depends_on", []),
+            "cost": a_dict.get("cost", "cheap"),
+        }
+
+
+    def get_pipeline(self, asset_key):
+        """ Returns a ready-to-run copy of a declarative asset's pipeline. """
+
+        stat = self.get_stat(asset_key)
+        pipeline = deepcopy(stat["pipeline"])
+
+        if stat["since"] is not None:
+            attrib, days = stat["since"]
+            cutoff = datetime.now() - timedelta(days=days)
+            pipeline.insert(0, {"$match": {attrib: {"$gte": cutoff}}})
+
+        if self.query_debug:
+            self.logger.debug("MDB  name:   %s" % utils.mdb.name)
+            self.logger.debug("MDB pipeline:   %s" % pipeline)
+
+        return pipeline
+
+
+    def get_pipeline_value(self, asset_key, results):
+        """ Turns the list of documents that comes back from a declarative
+        asset's pipeline into its value. """
+
+        if results == []:
+            return self.get_stat(asset_key)["default"]
+        return results[0]["value"]
+
+
     def update_asset_dict(self, asset_dict):
         """ this is where the magic happens: a valid asset_dict goes in and a
-        fully fleshed-out asset dictionary with current data comes out. """
+        fully fleshed-out asset dictionary with current data comes out.
 
-        if asset_dict["handle"] not in dir(self):
-            msg = "Could not refresh '%s' asset: no such world.World class method exists!" % asset_dict["handle"]
-            self.logger.exception(msg)
-            raise Exception(msg)
+        Declarative assets run their pipeline; everything else calls the World
+        method with the same name as the asset's handle. """
+
+        stat = self.get_stat(asset_dict["handle"])
 
         try:
-            exec "value = self.%s()" % asset_dict["handle"]
+            if stat["pipeline"] is not None:
+                results = list(utils.mdb[stat["collection"]].aggregate(self.get_pipeline(asset_dict["handle"])))
+                value = self.get_pipeline_value(asset_dict["handle"], results)
+            else:
+                method = getattr(self, asset_dict["handle"], None)
+                if method is None:
+                    msg = "Could not refresh '%s' asset: no such world.World class method exists!" % asset_dict["handle"]
+                    self.logger.exception(msg)
+                    raise Exception(msg)
+                value = method()
         except Exception as e:
             self.logger.error("Could not update asset dictionary for '%s' world asset!" % asset_dict["handle"])
             self.logger.exception(e)
             raise
 
+        return self.set_asset_value(asset_dict, value)
+
+
+    def set_asset_value(self, asset_dict, value):
+        """ Sets 'value', 'value_type' and 'created_on' on an asset dict. """
+
         asset_dict.update({"created_on": datetime.now()})
         asset_dict.update({"value": value})
 
@@ -175,15 +515,38 @@ class World:
         return asset_dict
 
 
-    def update_mdb(self, asset_dict):
-        """ Creates a new document in mdb.world OR, if this handle already
-        exists, updates an existing one. """
+    def update_mdb(self, results):
+        """ Writes a list of (asset_dict, error) tuples (i.e. what comes back
+        from self.refresh_asset_dict()) to mdb.world in one bulk write.
 
-        existing_asset = utils.mdb.world.find_one({"handle": asset_dict["handle"]})
-        if existing_asset is not None:
-            asset_dict["_id"] = existing_asset["_id"]
-        utils.mdb.world.save(asset_dict)
-        utils.mdb.world.create_index("handle", unique=True)
+        Refreshed assets are upserted on their handle; failed ones only get
+        their failure count incremented, so the last good value sticks
+        around. """
+
+        requests = []
+        for asset_dict, error in results:
+            if error is None:
+                requests.append(UpdateOne(
+                    {"handle": asset_dict["handle"]},
+                    {"$set": asset_dict},
+                    upsert=True,
+                ))
+            else:
+                requests.append(UpdateOne(
+                    {"handle": asset_dict["handle"]},
+                    {
+                        "$inc": {"refresh_failures": 1},
+                        "$set": {
+                            "refresh_duration": asset_dict["refresh_duration"],
+                            "last_failure": datetime.now(),
+                            "last_error": str(error),
+                        },
+                    },
+                ))
+
+        if requests != []:
+            utils.mdb.world.bulk_write(requests, ordered=False)
+            self.logger.debug("Updated %s asset(s) in mdb." % len(requests))
 
 
     def remove(self, asset_id):
@@ -199,8 +562,9 @@ class World:
     def list(self, output_type="JSON"):
         """ Dump world data in a few different formats."""
 
-        # initialize our final dict
-        d = utils.api_meta
+        # initialize our final dict; work on a copy of the meta stub, since
+        #   it's shared by everything else in the process
+        d = deepcopy(utils.api_meta)
         d["meta"]["object"]["panel_revision"] = settings.get("application","panel_revision")
         d["world"] = collections.OrderedDict()
 
@@ -223,7 +587,7 @@ class World:
                 if type(chk_d[k]) == dict:
                     recursive_key_del(chk_d[k], f_key)
 
-        for banned_key in ["max_age", "email","admins"]:
+        for banned_key in ["max_age", "email", "admins", "last_error"]:
             recursive_key_del(raw_world, banned_key)
 
 
@@ -279,30 +643,61 @@ class World:
 
     def pretty_survivor(self, survivor):
         """ Clean a survivor up and make it 'shippable' as part of the world
-        JSON. This initializes the survivor and will normalize it. """
+        JSON. See pretty_survivors() below. """
+
+        return self.pretty_survivors([survivor])[0]
+
+
+    def pretty_survivors(self, survivors):
+        """ Cleans up a list of raw survivor documents for the world JSON:
+        adds pretty epithets, age and settlement name, and redacts attribute
+        detail.
+
+        This does NOT initialize any Survivor or Settlement objects: epithet
+        names come from the epithet asset collection and settlement names come
+        from one $in query for the whole list. """
 
-        # init
-        S = survivors_models.Survivor(_id=survivor["_id"], normalize_on_init=False)
-        survivor["epithets"] = S.get_epithets("pretty")
-        survivor["age"] = utils.get_time_elapsed_since(survivor["created_on"], "age")
+        if getattr(self, "epithets", None) is None:
+            self.epithets = epithets_models.Assets()
 
-        # redact/remove
-        survivor["attribute_detail"] = 'REDACTED'
+        settlement_oids = list(set([s["settlement"] for s in survivors]))
+        settlement_names = {}
+        for settlement in utils.mdb.settlements.find({"_id": {"$in": settlement_oids}}, {"name": 1}):
+            settlement_names[settlement["_id"]] = settlement["name"]
 
-        # add settlement info
-        settlement = utils.mdb.settlements.find_one({"_id": survivor["settlement"]})
-        survivor["settlement_name"] = settlement["name"]
+        for survivor in survivors:
+            pretty_epithets = ""
+            for e_handle in survivor.get("epithets", []):
+                e_asset = self.epithets.get_asset(e_handle, backoff_to_name=True, raise_exception_if_not_found=False)
+                if e_asset is None:
+                    self.logger.warn("Unknown epithet '%s' on survivor %s!" % (e_handle, survivor["_id"]))
+                    continue
+                pretty_epithets += e_asset["name"]
+            survivor["epithets"] = pretty_epithets
+            survivor["age"] = utils.get_time_elapsed_since(survivor["created_on"], "age")
 
-        return survivor
+            # redact/remove
+            survivor["attribute_detail"] = 'REDACTED'
 
+            # add settlement info
+            survivor["settlement_name"] = settlement_names.get(survivor["settlement"], None)
 
-    def get_eligible_documents(self, collection=None, required_attribs=None, limit=None, exclude_dead_survivors=True, include_settlement=False, sort_on=None):
-        """ Returns a dict representing the baseline mdb query for a given
-        collection.
+        return survivors
+
+
+    def get_eligible_documents(self, collection=None, required_attribs=None, limit=None, exclude_dead_survivors=True, include_settlement=False, sort_on=None, projection=None):
+        """ Runs the baseline mdb query for a given collection.
 
         This should be used pretty much any time we need to go to the mdb for
         data. Writing direct queries is OK for one-offs, but this saves a lot of
         time and helps keep things DRY.
+
+        Without a 'limit', this returns a (lazy) cursor, so callers should just
+        iterate it rather than turning it into a list. With a 'limit', it
+        returns the 'limit'-th most recent document (or None). Use 'projection'
+        (a list of attribs or a pymongo projection dict) to keep from hauling
+        whole timelines, storage lists, etc. back from the mdb when all you
+        want is one attrib.
         """
 
 
@@ -344,42 +739,38 @@ class World:
         else:
             self.logger.error("The collections '%s' is not within the scope of world.py")
 
-        # get results
+        if self.query_debug:
+            self.logger.debug("MDB  name:   %s" % utils.mdb.name)
+            self.logger.debug("MDB query:   %s" % query)
+
+        # a whole-collection scan doesn't need sorting (and sorting a big one
+        #   can blow out the mdb's in-memory sort limit)
+        if limit is None:
+            if sort_on is not None:
+                return utils.mdb[collection].find(query, projection, sort=[(sort_on, -1)])
+            return utils.mdb[collection].find(query, projection)
+
         sort_params = [("created_on",-1)]
         if sort_on is not None:
             sort_params = [(sort_on, -1)]
-        results = utils.mdb[collection].find(query, sort=sort_params)
+        results = list(utils.mdb[collection].find(query, projection, sort=sort_params).skip(limit - 1).limit(1))
 
-        # log an exception if results is None
-        if results is None:
-            self.logger.exception(utils.WorldQueryError(query=query))
-            return None
-        elif results.count() == 0:
+        if results == []:
             self.logger.exception(utils.WorldQueryError(query=query))
             return None
-
-        # change results from a query object to a list
-        results = [x for x in results]
-
-        # hack around the dumbass implementation of .limit() in mongo
-        if limit is not None:
-            return results[limit - 1]
-        else:
-            return results
+        return results[0]
 
 
     def get_minmax(self, collection=None, attrib=None):
         """ Gets the highest/lowest value for 'attrib' across all eligible
         documents in 'collection'. Returns a tuple. """
 
-        sample_set = self.get_eligible_documents(collection, attrib)
-
-        if sample_set is None:
-            return (None, None)
-
         data_points = []
-        for sample in sample_set:
+        for sample in self.get_eligible_documents(collection, attrib, projection=[attrib]):
             data_points.append(int(sample[attrib]))
+
+        if data_points == []:
+            return (None, None)
         return min(data_points), max(data_points)
 
 
@@ -391,17 +782,15 @@ class World:
         'precision' kwarg to modify rounding precision and 'return_type' to
         coerce the return a str or int as desired. """
 
-        sample_set = self.get_eligible_documents(collection, attrib)
-
-        if sample_set is None:
-            return None
-
         data_points = []
-        for sample in sample_set:
+        for sample in self.get_eligible_documents(collection, attrib, projection=[attrib]):
             try:
                 data_points.append(return_type(sample[attrib]))
             except: # in case we need to coerce a list to an int
                 data_points.append(return_type(len(sample[attrib])))
+
+        if data_points == []:
+            return None
         result = reduce(lambda x, y: x + y, data_points) / float(len(data_points))
 
         # coerce return based on 'return_type' kwarg
@@ -422,6 +811,53 @@ class World:
         return round(result,2)
 
 
+    def get_alias_map(self, asset_dicts):
+        """ Takes a list of asset dicts and returns a dict mapping both the
+        name and the handle of each asset to its handle. Legacy (V1) documents
+        store names where V2 documents store handles, so this is what we use to
+        fold them together. """
+
+        aliases = {}
+        for a_dict in asset_dicts:
+            aliases[a_dict["name"]] = a_dict["handle"]
+            aliases[a_dict["handle"]] = a_dict["handle"]
+        return aliases
+
+    def get_array_popularity(self, collection=None, attrib=None, aliases={}):
+        """ Assuming that 'collection' documents have a list type 'attrib',
+        this does one aggregation pass over the collection and returns a
+        Counter of how many documents each value turns up in.
+
+        Values are normalized to handles via the 'aliases' dict (see
+        get_alias_map() above) on the mdb side; anything that isn't in there
+        is dropped. A document that has a value more than once (e.g. under
+        its legacy name AND its handle) only gets counted once. """
+
+        alias_keys = aliases.keys()
+        alias_handles = [aliases[k] for k in alias_keys]
+
+        pipeline = [
+            {"$match": {attrib: {"$exists": True}}},
+            {"$project": {attrib: 1}},
+            {"$unwind": "$%s" % attrib},
+            {"$match": {attrib: {"$in": alias_keys}}},
+            {"$project": {"handle": {"$arrayElemAt": [
+                alias_handles,
+                {"$indexOfArray": [alias_keys, "$%s" % attrib]},
+            ]}}},
+            {"$group": {"_id": {"doc": "$_id", "handle": "$handle"}}},
+            {"$group": {"_id": "$_id.handle", "count": {"$sum": 1}}},
+        ]
+
+        if self.query_debug:
+            self.logger.debug("MDB  name:   %s" % utils.mdb.name)
+            self.logger.debug("MDB pipeline:   %s" % pipeline)
+
+        counts = collections.Counter()
+        for r in utils.mdb[collection].aggregate(pipeline):
+            counts[r["_id"]] += r["count"]
+        return counts
+
     def get_top(self, collection=None, attrib=None, limit=None, asset_type=str):
         """ Assuming that 'collection' documents have a 'attrib' attribute, this
         will return the top five most popular names along with their counts. """
@@ -443,12 +879,11 @@ class World:
                 i["count"] = int(i["count"])
 
         elif asset_type == list:
-            sample_set = self.get_eligible_documents(collection, attrib)
-            if sample_set is None:
-                return None
             master_list = []
-            for s in sample_set:
+            for s in self.get_eligible_documents(collection, attrib, projection=[attrib]):
                 master_list.extend(s[attrib])
+            if master_list == []:
+                return None
             master_dict = {}
             for i in master_list:
                 if i in master_dict.keys():
@@ -496,45 +931,25 @@ class World:
 
     # survivors
     def total_survivors(self):
-        return utils.mdb.survivors.find().count()
+        return counters.get("total_survivors")
 
     def live_survivors(self):
-        return utils.mdb.survivors.find({"dead": {"$exists": False}}).count()
+        return counters.get("live_survivors")
 
     def dead_survivors(self):
-        return utils.mdb.survivors.find({"dead": {"$exists": True}}).count()
+        return counters.get("dead_survivors")
 
     # settlements
     def total_settlements(self):
-        return utils.mdb.settlements.find().count()
+        return counters.get("total_settlements")
 
     def active_settlements(self):
         return self.total_settlements() - self.abandoned_settlements()
 
-    def removed_settlements(self):
-        return utils.mdb.settlements.find({"removed": {"$exists": True}}).count()
-
     def abandoned_settlements(self):
-        return utils.mdb.settlements.find({"abandoned": {"$exists": True}}).count()
-
-    def abandoned_or_removed_settlements(self):
-        return utils.mdb.settlements.find({"$or": [
-            {"removed": {"$exists": True}},
-            {"abandoned": {"$exists": True}},
-        ]}).count()
+        return counters.get("abandoned_settlements")
 
 
-    def total_users(self):
-        return utils.mdb.users.find().count()
-
-    def total_users_last_30(self):
-        thirty_days_ago = datetime.now() - timedelta(days=30)
-        return utils.mdb.users.find({"latest_activity": {"$gte": thirty_days_ago}}).count()
-
-    def new_settlements_last_30(self):
-        thirty_days_ago = datetime.now() - timedelta(days=30)
-        return utils.mdb.settlements.find({"created_on": {"$gte": thirty_days_ago}}).count()
-
     def recent_sessions(self):
         recent_session_cutoff = datetime.now() - timedelta(hours=settings.get("application", "recent_user_horizon"))
         return utils.mdb.users.find({"latest_activity": {"$gte": recent_session_cutoff}}).count()
@@ -654,7 +1069,7 @@ class World:
         return k
 
     def latest_survivor(self):
-        s = self.get_eligible_documents(collection="survivors", limit=1, include_settlement=True)
+        s = self.get_eligible_documents(collection="survivors", limit=1, include_settlement=True, projection={"attribute_detail": 0})
         return self.pretty_survivor(s)
 
     def latest_fatality(self):
@@ -665,6 +1080,7 @@ class World:
             exclude_dead_survivors=False,
             include_settlement=True,
             sort_on="died_on",
+            projection={"attribute_detail": 0},
         )
         return self.pretty_survivor(s)
 
@@ -696,35 +1112,72 @@ class World:
     # compound returns below. Unlike the above functions, these return dict
     # and list type objects
 
-    def killboard(self):
-        known_types = utils.mdb.killboard.find().distinct("type")
+    def get_kill_counts(self, since=None, settlement_id=None, campaign=None):
+        """ Does one $group over mdb.killboard and returns kill counts as a
+        dict of monster types, each of which is a dict of counts keyed on
+        monster handle.
+
+        Use 'since' (a datetime) to only count recent kills, 'settlement_id'
+        (an ObjectId) to only count one settlement's kills, and 'campaign' (a
+        campaign handle) to only count kills by settlements playing that
+        campaign. """
+
+        match = {"handle": {"$exists": True}, "type": {"$exists": True}}
+        if since is not None:
+            match["created_on"] = {"$gte": since}
+        if settlement_id is not None:
+            match["settlement_id"] = settlement_id
+
+        pipeline = [{"$match": match}]
+
+        # legacy settlements store campaign names; PotL ones might not have a
+        #   campaign at all
+        if campaign is not None:
+            c_asset = campaigns_models.Assets().get_asset(campaign)
+            aliases = [c_asset["handle"], c_asset["name"]]
+            if c_asset["handle"] == "people_of_the_lantern":
+                aliases.append(None)
+            pipeline.extend([
+                {"$lookup": {"from": "settlements", "localField": "settlement_id", "foreignField": "_id", "as": "settlement"}},
+                {"$match": {"settlement.campaign": {"$in": aliases}}},
+            ])
+
+        pipeline.append({"$group": {"_id": {"type": "$type", "handle": "$handle"}, "count": {"$sum": 1}}})
+
+        if self.query_debug:
+            self.logger.debug("MDB  name:   %s" % utils.mdb.name)
+            self.logger.debug("MDB pipeline:   %s" % pipeline)
+
+        kill_counts = {}
+        for r in utils.mdb.killboard.aggregate(pipeline):
+            kill_counts.setdefault(r["_id"]["type"], {})[r["_id"]["handle"]] = r["count"]
+        return kill_counts
 
-        if known_types == []:
+
+    def killboard(self, since=None, settlement_id=None, campaign=None):
+        """ Returns a dict of monster types, each of which is a list of monster
+        dicts (with kill counts) in sort order.
+
+        Without any kwargs, this is the world killboard and it comes from the
+        killboard counter (see counters.py). Otherwise, the kwargs are passed
+        to get_kill_counts() (see above). """
+
+        if since is None and settlement_id is None and campaign is None:
+            kill_counts = counters.get("killboard")
+        else:
+            kill_counts = self.get_kill_counts(since, settlement_id, campaign)
+
+        if kill_counts == {}:
             self.logger.exception("No kills in mdb! Returning None for killboard...")
             return None
 
         killboard = {}
-        for t in known_types:
-            killboard[t] = {}
-        monster_assets = monster_models.Assets()
-        for m_handle in monster_assets.get_handles():
-            m_asset = monster_assets.get_asset(m_handle)
-            killboard[m_asset["type"]][m_handle] = {"name": m_asset["name"], "count": 0, "sort_order": m_asset["sort_order"]}
-        results = utils.mdb.killboard.find({"handle": {"$exists": True}, "type": {"$exists": True}})
-        for d in results:
-            killboard[d["type"]][d["handle"]]["count"] += 1
-
-        for type in killboard.keys():
-            sort_order_dict = {}
-            for m in killboard[type].keys():
-                m_dict = killboard[type][m]
-                m_dict.update({"handle": m})
-                sort_order_dict[int(m_dict["sort_order"])] = m_dict
-
+        for type, monsters in get_monster_catalog().iteritems():
             killboard[type] = []
             previous = -1
-            for k in sorted(sort_order_dict.keys()):
-                m_dict = sort_order_dict[k]
+            for m_dict in sorted(monsters.values(), key=lambda m: int(m["sort_order"])):
+                m_dict = copy(m_dict)
+                m_dict["count"] = kill_counts.get(type, {}).get(m_dict["handle"], 0)
                 if m_dict["sort_order"] <= previous:
                     self.logger.error("Sorting error! %s sort order (%s) is not greater than previous (%s)!" % (m_dict["name"], m_dict["sort_order"], previous))
                 killboard[type].append(m_dict)
@@ -732,6 +1185,9 @@ class World:
 
         return killboard
 
+    def killboard_last_7(self):
+        return self.killboard(since=datetime.now() - timedelta(days=7))
+
     def top_survivor_names(self):
         return self.get_top("survivors","name")
 
@@ -748,38 +1204,45 @@ class World:
         I = innovations_models.Assets()
         I.filter("type", ["principle"])
 
+        i_dicts = I.get_dicts()
+        counts = self.get_array_popularity("settlements", "innovations", self.get_alias_map(i_dicts))
+
         all_results = []
-        for i_dict in I.get_dicts():
-            aliases = [i_dict["name"], i_dict["handle"]]
-            results = utils.mdb.settlements.find({"innovations": {"$in": aliases}})
+        for i_dict in i_dicts:
             all_results.append({
                 "name": i_dict["name"],
                 "handle": i_dict["handle"],
-                "count": results.count(),
+                "count": counts[i_dict["handle"]],
             })
 
         return sorted(all_results, key=lambda x: x["count"], reverse=1)
 
     def principle_selection_rates(self):
-        """ This is pretty much a direct port from V1. It's still a hot mess.
-        This should probably get a refactor prior to launch. """
+        """ This is pretty much a direct port from V1, except that all of the
+        counting gets done in one aggregation now.
+
+        Sample size is the sum of the option totals for a principle, since a
+        settlement only gets to pick one option per principle. """
 
         I = innovations_models.Assets()
         mep_dict = I.get_mutually_exclusive_principles()
 
+        aliases = {}
+        for tup in mep_dict.values():
+            for option_list in tup:
+                for alias in option_list:
+                    aliases[alias] = option_list[1]
+        counts = self.get_array_popularity("settlements", "principles", aliases)
+
         popularity_contest = {}
         for principle in mep_dict.keys():
             tup = mep_dict[principle]
 
-            all_options = []
-            for l in tup:
-                all_options.extend(l)
-
-            sample_set = utils.mdb.settlements.find({"principles": {"$in": all_options} }).count()
+            sample_set = sum([counts[option_list[1]] for option_list in tup])
             popularity_contest[principle] = {"sample_size": sample_set, "options": []}
 
             for option_list in tup:
-                total = utils.mdb.settlements.find({"principles": {"$in": option_list}}).count()
+                total = counts[option_list[1]]
                 option_pretty_name = option_list[0]
                 popularity_contest[principle]["options"].append(option_pretty_name)
                 popularity_contest[principle][option_pretty_name] = {
@@ -792,15 +1255,13 @@ class World:
         """ Uses the assets in assets/expansions.py to return a popularity
         contest dict re: expansions stored on settlement objects. """
 
-        popularity_contest = {}
-
         expansions_assets = expansions_models.Assets()
-        for e in expansions_assets.get_handles():
-            e_dict = expansions_assets.get_asset(e)
-            e_name_count = utils.mdb.settlements.find({"expansions": {"$in": [e_dict["name"]]}}).count()
-            e_handle_count = utils.mdb.settlements.find({"expansions": {"$in": [e]}}).count()
-            popularity_contest[e_dict["name"]] = e_name_count
-            popularity_contest[e_dict["name"]] += e_handle_count
+        e_dicts = [expansions_assets.get_asset(e) for e in expansions_assets.get_handles()]
+        counts = self.get_array_popularity("settlements", "expansions", self.get_alias_map(e_dicts))
+
+        popularity_contest = {}
+        for e_dict in e_dicts:
+            popularity_contest[e_dict["name"]] = counts[e_dict["handle"]]
 
         sorted_keys = sorted(popularity_contest, key=lambda x: popularity_contest[x], reverse=1)
         return [{'name': k, 'count': popularity_contest[k]} for k in sorted_keys]
@@ -833,34 +1294,80 @@ class World:
 
 
     def current_hunt(self):
-        """ Uses settlements with a 'current_quarry' attribute to determine who
-        is currently hunting monsters.
+        """ Returns the most recently started hunt that is still going on (see
+        live_activity.py), or None if nobody is hunting. """
 
-        The mdb query is totally custom, so it's written out here, rather than
-        stashed in a method of the World object, etc. """
+        hunts = live_activity.get_hunts(1, self.ineligible_names)
+        if hunts == []:
+            return None
+        return hunts[0]
 
-        settlement = utils.mdb.settlements.find_one(
-            {
-                "removed": {"$exists": False},
-                "abandoned": {"$exists": False},
-                "name": {"$nin": self.ineligible_names},
-                "current_quarry": {"$exists": True},
-                "hunt_started": {"$gte": datetime.now() - timedelta(minutes=180)},
-            }, sort=[("hunt_started", -1)],
-        )
+    def current_hunts(self):
+        """ Like current_hunt(), except that it returns a list of the
+        settings.world.live_activity_limit most recently started hunts. """
 
-        if settlement is None:
-            return None
+        return live_activity.get_hunts(settings.get("world","live_activity_limit"), self.ineligible_names)
 
-        hunters = utils.mdb.survivors.find({
-            "settlement": settlement["_id"],
-            "in_hunting_party": {"$exists": True},
-        }).sort("name")
 
-        if hunters.count() == 0:
-            return None
+#
+#   monster catalog: monster assets don't change without a restart, so the
+#       killboard only needs to build this once per process
+#
+
+monster_catalog = {}
+
+
+def get_monster_catalog():
+    """ Returns a dict of monster types, each of which is a dict of monster
+    dicts (handle, name and sort_order only) keyed on monster handle. Don't
+    modify what comes back from this: copy it. """
+
+    if monster_catalog == {}:
+        monster_assets = monster_models.Assets()
+        for m_handle in monster_assets.get_handles():
+            m_asset = monster_assets.get_asset(m_handle)
+            monster_catalog.setdefault(m_asset["type"], {})[m_handle] = {
+                "handle": m_handle,
+                "name": m_asset["name"],
+                "sort_order": m_asset["sort_order"],
+            }
+    return monster_catalog
+
+
+
+#
+#   snapshot helpers: the API uses these to serve the /world snapshot that the
+#       World.publish_snapshot() method writes (see above)
+#
+
+snapshot_cache = {"version": None, "checked_on": None, "snapshot": None}
+
+
+def get_snapshot():
+    """ Returns the current /world snapshot document. Each API worker keeps a
+    copy in memory and only re-fetches it from mdb if the version number has
+    changed (and it only checks the version every so often). """
+
+    check_interval = timedelta(seconds=settings.get("world","snapshot_check_interval"))
+    now = datetime.now()
+
+    if snapshot_cache["checked_on"] is not None and now - snapshot_cache["checked_on"] < check_interval:
+        return snapshot_cache["snapshot"]
+
+    current = utils.mdb.world_snapshot.find_one({"_id": "world"}, {"version": 1})
+
+    # if the daemon hasn't published one yet, make one ourselves
+    if current is None:
+        World().publish_snapshot()
+        current = utils.mdb.world_snapshot.find_one({"_id": "world"}, {"version": 1})
+
+    if current["version"] != snapshot_cache["version"]:
+        snapshot_cache["snapshot"] = utils.mdb.world_snapshot.find_one({"_id": "world"})
+        snapshot_cache["version"] = current["version"]
+
+    snapshot_cache["checked_on"] = now
+    return snapshot_cache["snapshot"]
 
-        return {"settlement": settlement, "survivors": [h for h in hunters]}
 
 
 #
@@ -888,6 +1395,12 @@ class WorldDaemon:
         self.pid_file_path = os.path.join(self.pid_dir, "world_daemon.pid")
         self.set_pid()
 
+        # scheduler state; see run()
+        self.queue = []
+        self.due = {}
+        self.failures = {}
+        self.shutting_down = False
+
 
 
     def check_pid_dir(self):
@@ -983,30 +1496,142 @@ class WorldDaemon:
             detach_process = True,
             umask=0o002, pidfile=PIDLockFile(self.pid_file_path),
             files_preserve = [self.logger.handlers[0].stream],
+            signal_map = {signal.SIGTERM: self.handle_sigterm},
         )
 
         with context:
-            while True:
-                try:
-                    self.run()
-                except Exception as e:
-                    self.logger.error("An exception occured during daemonization!")
-                    self.logger.exception(e)
-                    raise
+            try:
+                self.run()
+            except Exception as e:
+                self.logger.error("An exception occured during daemonization!")
+                self.logger.exception(e)
+                raise
+
+
+    def handle_sigterm(self, signum, frame):
+        """ Asks the scheduler to stop once it's done with whatever it's
+        doing, so that we never get killed in the middle of a write. """
+
+        self.logger.warn("Caught SIGTERM! World Daemon will exit after the current refresh...")
+        self.shutting_down = True
+
+
+    def schedule(self, asset_key, due):
+        """ Puts an asset on the queue, due at 'due' (a unix timestamp).
+        Rescheduling an asset leaves its old entry on the heap: it gets
+        skipped when it comes up, since it won't match self.due anymore. """
+
+        self.due[asset_key] = due
+        heapq.heappush(self.queue, (due, asset_key))
+
+
+    def reschedule(self, W, results):
+        """ Reschedules refreshed assets. Assets that refreshed OK are due
+        again after their max age (but never sooner than
+        settings.world.min_reschedule_interval seconds), plus up to
+        world.schedule_jitter of it (so that everything doesn't come due at
+        once); failed assets back off exponentially, from world.backoff_base
+        seconds up to world.backoff_max seconds. """
+
+        now = time.time()
+        for asset_dict, error in results:
+            asset_key = asset_dict["handle"]
+            if error is None:
+                self.failures.pop(asset_key, None)
+                max_age = max(W.get_max_age(asset_dict), settings.get("world","min_reschedule_interval"))
+                jitter = random.uniform(0, max_age * float(settings.get("world","schedule_jitter")))
+                self.schedule(asset_key, now + max_age + jitter)
+            else:
+                self.failures[asset_key] = self.failures.get(asset_key, 0) + 1
+                backoff = settings.get("world","backoff_base") * 2 ** (self.failures[asset_key] - 1)
+                backoff = min(backoff, settings.get("world","backoff_max"))
+                self.logger.warn("'%s' has failed %s time(s) in a row! Retrying in %s seconds..." % (asset_key, self.failures[asset_key], backoff))
+                self.schedule(asset_key, now + backoff)
+
+
+    def pop_due(self):
+        """ Pops every asset that is due off of the queue and returns their
+        handles. """
+
+        now = time.time()
+        due = []
+        while self.queue != [] and self.queue[0][0] <= now:
+            due_time, asset_key = heapq.heappop(self.queue)
+            if self.due.get(asset_key, None) != due_time:
+                continue
+            del self.due[asset_key]
+            due.append(asset_key)
+        return due
+
+
+    def save_queue(self):
+        """ Saves the queue to mdb.world_daemon, so that dump_status() (which
+        usually gets called from some other process) can report on it. """
+
+        utils.mdb.world_daemon.update(
+            {"_id": "queue"},
+            {
+                "_id": "queue",
+                "due": dict([(k, datetime.fromtimestamp(v)) for k, v in self.due.iteritems()]),
+                "failures": self.failures,
+                "updated_on": datetime.now(),
+            },
+            upsert=True,
+        )
 
 
     def run(self):
-        """ A run involves checking all warehouse assets and, if they're older
-        than their 'max_age' attrib (default to the world.asset_max_age value),
-        it refreshes them.
+        """ Keeps a priority queue of warehouse assets, ordered by when each
+        one is due for a refresh, and wakes up exactly when the next one is.
 
-        Once finished, it sleeps for world.refresh_interval, which is measured
-        in minutes. """
+        On startup, everything is scheduled based on the age of what's in the
+        mdb (so stale assets are due right away). After that, each refreshed
+        asset gets rescheduled (see reschedule()). The /world snapshot only
+        gets republished when something actually got refreshed. The daemon
+        never sleeps for longer than world.refresh_interval minutes, and it
+        stops at the top of the loop after a SIGTERM. """
 
         W = World()
-        W.refresh_all_assets()
-        self.logger.debug("World Daemon will sleep for %s minutes..." % settings.get("world","refresh_interval"))
-        time.sleep(settings.get("world","refresh_interval") * 60)
+        utils.mdb.world.create_index("handle", unique=True)
+
+        created_on = {}
+        for mdb_asset in utils.mdb.world.find({}, {"handle": 1, "created_on": 1}):
+            created_on[mdb_asset["handle"]] = mdb_asset.get("created_on", None)
+
+        now = time.time()
+        for asset_key in W.assets.keys():
+            if created_on.get(asset_key, None) is None:
+                self.schedule(asset_key, now)
+            else:
+                asset_age = (datetime.now() - created_on[asset_key]).total_seconds()
+                max_age = W.get_max_age(W.initialize_asset_dict(asset_key))
+                self.schedule(asset_key, now + max_age - asset_age)
+
+        while not self.shutting_down:
+            counters.reconcile()
+
+            due = self.pop_due()
+            if due != []:
+                stale_assets = dict([(k, W.initialize_asset_dict(k)) for k in due])
+                stale_assets = W.add_dependents(stale_assets)
+                results = W.refresh_assets(stale_assets)
+                self.reschedule(W, results)
+                refreshed = len([r for r in results if r[1] is None])
+                self.logger.info("Refreshed %s/%s due asset(s)." % (refreshed, len(stale_assets)))
+                self.save_queue()
+                if refreshed > 0:
+                    W.publish_snapshot()
+
+            if self.shutting_down:
+                break
+
+            sleep_for = settings.get("world","refresh_interval") * 60
+            if self.queue != []:
+                sleep_for = max(0, min(sleep_for, self.queue[0][0] - time.time()))
+            self.logger.debug("World Daemon will sleep for %s seconds..." % int(sleep_for))
+            time.sleep(sleep_for)   # a SIGTERM cuts this short
+
+        self.logger.warn("World Daemon has stopped.")
 
 
     def stop(self):
@@ -1015,12 +1640,17 @@ class WorldDaemon:
         self.set_pid()
         self.logger.warn("Preparing to kill PID %s..." % self.pid)
         if self.pid is not None:
-            os.kill(self.pid, 15)
-            time.sleep(2)
-            try:
-                os.kill(self.pid, 0)
-            except:
-                self.logger.warn("PID %s has been killed." % self.pid)
+            os.kill(self.pid, signal.SIGTERM)
+
+            # give the scheduler a chance to finish whatever it's writing
+            for i in range(settings.get("world","shutdown_timeout")):
+                time.sleep(1)
+                try:
+                    os.kill(self.pid, 0)
+                except OSError:
+                    self.logger.warn("PID %s has been killed." % self.pid)
+                    return True
+            self.logger.error("PID %s is still running after %s seconds!" % (self.pid, settings.get("world","shutdown_timeout")))
         else:
             self.logger.debug("Daemon is not running. Ignoring stop command...")
 
@@ -1072,6 +1702,20 @@ class WorldDaemon:
             d["pid_file"] = self.pid_file_path
             d["assets"] = utils.mdb.world.find().count()
 
+            # scheduler queue depth and lag
+            queue = utils.mdb.world_daemon.find_one({"_id": "queue"})
+            if queue is not None:
+                now = datetime.now()
+                overdue = [v for v in queue["due"].values() if v <= now]
+                d["queue_scheduled"] = len(queue["due"])
+                d["queue_depth"] = len(overdue)
+                d["queue_lag_seconds"] = 0
+                if overdue != []:
+                    d["queue_lag_seconds"] = int((now - min(overdue)).total_seconds())
+                if queue["due"] != {}:
+                    d["queue_next_due"] = min(queue["due"].values())
+                d["failing_assets"] = queue["failures"]
+
         if output_type == dict:
             return d
         elif output_type == "CLI":
@@ -1108,6 +1752,9 @@ if __name__ == "__main__":
     parser.add_option("-a", dest="asset", default=False, help="Retrieve an mdb world asset (print a summary)", metavar="latest_survivor")
     parser.add_option("-q", dest="query", default=False, help="Execute a query method (print results)", metavar="avg_pop")
     parser.add_option("-R", dest="remove_one", default=None, help="Remove an object _id from the warehouse", metavar="57f010ec4...")
+    parser.add_option("-x", dest="explain", default=False, help="Explain how an asset is computed (runs an mdb explain for declarative assets)", metavar="total_users")
+    parser.add_option("-n", dest="dry_run", action="store_true", default=False, help="Print the refresh plan without refreshing anything (use with -r to plan a forced refresh)")
+    parser.add_option("-c", dest="reconcile", action="store_true", default=False, help="Reconcile world counters against full queries")
     parser.add_option("-d", dest="daemon_cmd", help="Daemon controls: status|start|stop|restart", default=None, metavar="restart")
     (options, args) = parser.parse_args()
 
@@ -1115,9 +1762,15 @@ if __name__ == "__main__":
     W = World()
     if options.remove_one is not None:
         W.remove(options.remove_one)
-    if options.refresh:
+    if options.reconcile:
+        counters.reconcile(force=True)
+    if options.dry_run:
+        W.dry_run(force=options.refresh)
+    elif options.refresh:
         W.logger.debug("Beginning forced asset refresh...")
         W.refresh_all_assets(force=True)
+    if options.explain:
+        W.explain(options.explain)
     if options.asset:
         print(W.dump(options.asset))
     if options.update: